@@ -0,0 +1,201 @@
+"""Local archive of fetched posts for bot.py.
+
+Every post the bot fetches is stored serialized in an SQLite database (WAL
+mode, so the dispatcher and shard workers can share one file), together with
+its text and media metadata. Repeat requests for a post are answered from the
+archive instead of Telegram, and the text and file names are indexed with
+FTS5 for the /search command, which only searches public channels.
+
+The stored data is kept under a size budget by dropping the posts that were
+archived longest ago, after which the database is compacted in bulk.
+
+    ARCHIVE_FILE=archive.db python bot.py
+"""
+import logging
+import re
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+EVICT_TO = 0.9  # eviction frees space down to this fraction of the budget
+SEARCH_TERM = re.compile(r'\w+')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS messages ('
+    'id INTEGER PRIMARY KEY, '
+    'channel_id INTEGER NOT NULL, '
+    'message_id INTEGER NOT NULL, '
+    'channel_key TEXT NOT NULL, '
+    'date INTEGER, '
+    'text TEXT NOT NULL, '
+    'media_type TEXT, '
+    'file_name TEXT, '
+    'file_size INTEGER, '
+    'protected INTEGER NOT NULL, '
+    'data BLOB NOT NULL, '
+    'size INTEGER NOT NULL, '
+    'archived_at REAL NOT NULL, '
+    'UNIQUE (channel_id, message_id))',
+    'CREATE INDEX IF NOT EXISTS messages_by_age ON messages (archived_at)',
+    # External content table, so the text is stored once
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, file_name, content='messages', content_rowid='id')",
+    'CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN '
+    'INSERT INTO messages_fts (rowid, text, file_name) VALUES (new.id, new.text, new.file_name); END',
+    'CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN '
+    "INSERT INTO messages_fts (messages_fts, rowid, text, file_name) "
+    "VALUES ('delete', old.id, old.text, old.file_name); END",
+    'CREATE TRIGGER IF NOT EXISTS messages_update AFTER UPDATE ON messages BEGIN '
+    "INSERT INTO messages_fts (messages_fts, rowid, text, file_name) "
+    "VALUES ('delete', old.id, old.text, old.file_name); "
+    'INSERT INTO messages_fts (rowid, text, file_name) VALUES (new.id, new.text, new.file_name); END',
+)
+
+def connect(path):
+    """Open the archive database in WAL mode"""
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    # Only takes effect on a new file, before anything else writes to it
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def match_query(text):
+    """Turn user input into an FTS5 query matching all of its words"""
+    return ' '.join(f'"{term}"' for term in SEARCH_TERM.findall(text))
+
+class MessageArchive:
+    """Serialized posts indexed by (channel id, message id) and by their text"""
+
+    def __init__(self, path, max_bytes, max_age):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._conn = connect(path)
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self.bytes = self._stored_bytes()
+        self.hits = 0
+        self.stored = 0
+        self.evicted = 0
+        self.compactions = 0
+        self.needs_compaction = False
+
+    def _stored_bytes(self):
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM messages').fetchone()[0]
+
+    def get(self, channel_id, message_ids):
+        """Return {message id: serialized post} for the posts archived recently enough.
+
+        Protected posts with media are left out, since resending them needs
+        file references fresher than the archived ones.
+        """
+        placeholders = ','.join('?' * len(message_ids))
+        rows = self._conn.execute(
+            'SELECT message_id, data FROM messages '
+            f'WHERE channel_id = ? AND message_id IN ({placeholders}) '
+            'AND archived_at >= ? AND (protected = 0 OR media_type IS NULL)',
+            (channel_id, *message_ids, time.time() - self.max_age)
+        ).fetchall()
+        self.hits += len(rows)
+        return dict(rows)
+
+    def put(self, rows):
+        """Store posts, replacing earlier copies.
+
+        rows are (channel_id, message_id, channel_key, date, text, media_type,
+        file_name, file_size, protected, data) tuples.
+        """
+        archived_at = time.time()
+        added = 0
+        values = []
+        for row in rows:
+            size = len(row[9]) + len(row[4])
+            added += size
+            values.append((*row, size, archived_at))
+        self._conn.executemany(
+            'INSERT INTO messages (channel_id, message_id, channel_key, date, text, media_type, '
+            'file_name, file_size, protected, data, size, archived_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (channel_id, message_id) DO UPDATE SET '
+            'channel_key = excluded.channel_key, date = excluded.date, text = excluded.text, '
+            'media_type = excluded.media_type, file_name = excluded.file_name, '
+            'file_size = excluded.file_size, protected = excluded.protected, data = excluded.data, '
+            'size = excluded.size, archived_at = excluded.archived_at',
+            values
+        )
+        self.stored += len(values)
+        # Replaced copies and other processes make the running total approximate,
+        # so it is only used to decide when to count again
+        self.bytes += added
+        if self.bytes > self.max_bytes:
+            self.bytes = self._stored_bytes()
+            if self.bytes > self.max_bytes:
+                self._evict()
+        self._conn.commit()
+
+    def _evict(self):
+        """Delete the posts archived longest ago until the data fits the budget again"""
+        excess = self.bytes - int(self.max_bytes * EVICT_TO)
+        ids = []
+        oldest = self._conn.execute('SELECT id, size FROM messages ORDER BY archived_at')
+        for row_id, size in oldest:
+            if excess <= 0:
+                break
+            ids.append((row_id,))
+            excess -= size
+        oldest.close()  # an unfinished query would keep compaction from checkpointing
+        self._conn.executemany('DELETE FROM messages WHERE id = ?', ids)
+        self.bytes = self._stored_bytes()
+        self.evicted += len(ids)
+        self.needs_compaction = True
+        logger.info("Evicted %s posts from the archive", len(ids))
+
+    def compact(self):
+        """Merge the search index and give the space of evicted posts back to the disk.
+
+        Uses its own connection, so it can run in a thread next to the bot.
+        """
+        started = time.monotonic()
+        self.needs_compaction = False
+        conn = connect(self.path)
+        try:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+            conn.commit()
+            # executescript runs the pragma to the end, execute would free a single page
+            conn.executescript('PRAGMA incremental_vacuum;')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            conn.close()
+        self.compactions += 1
+        logger.info("Compacted the archive in %.2fs", time.monotonic() - started)
+
+    def search(self, text, limit):
+        """Return (channel key, message id, date, snippet) of the best matches for text.
+
+        Only posts from public channels are searched, so the private channel
+        links someone fetched aren't shown to everyone else.
+        """
+        query = match_query(text)
+        if not query:
+            return []
+        return self._conn.execute(
+            'SELECT m.channel_key, m.message_id, m.date, '
+            "snippet(messages_fts, -1, '', '', '…', 12) "
+            'FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid '
+            "WHERE messages_fts MATCH ? AND m.channel_key NOT LIKE 'c/%' "
+            'ORDER BY rank LIMIT ?',
+            (query, limit)
+        ).fetchall()
+
+    def stats(self):
+        """Return the stored bytes and the hit, store, eviction and compaction counts"""
+        return {
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'stored': self.stored,
+            'evicted': self.evicted,
+            'compactions': self.compactions,
+        }
@@ -0,0 +1,411 @@
+"""Load test for bot.py against an in-process fake Telegram client.
+
+Replays synthetic traffic (many users sending links, multi-link messages and
+commands) through the bot's router. The fake client answers every call after
+a configurable latency, can inject FloodWaits, and serves posts with media of
+the configured sizes from a mix of normal and protected channels. Nothing
+talks to Telegram.
+
+    python bench.py                       # compare with bench_baseline.json if it exists
+    python bench.py --requests 20000 --rate 500 --latency 0.02
+    python bench.py --save-baseline       # keep this run as the new baseline
+
+The report covers throughput, p50/p99 latency, API calls per request and
+memory growth. There is also a micro benchmark of check_cooldown and of
+cached is_user_subscribed calls.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+# Metrics compared with the baseline: name -> True if higher is better
+COMPARED = {
+    'throughput': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'api_calls_per_request': False,
+    'memory_growth_mb': False,
+    'check_cooldown_ops': True,
+    'is_user_subscribed_ops': True,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000, help='messages to replay')
+    parser.add_argument('--rate', type=float, default=250, help='messages per second')
+    parser.add_argument('--users', type=int, default=5000, help='distinct users sending them')
+    parser.add_argument('--channels', type=int, default=200, help='distinct source channels')
+    parser.add_argument('--protected', type=float, default=0.1, help='share of channels that forbid forwarding')
+    parser.add_argument('--subscribed', type=float, default=0.9, help='share of users subscribed to the bot channel')
+    parser.add_argument('--media', type=float, default=0.3, help='share of posts with media')
+    parser.add_argument('--media-sizes', default='200000,2000000,20000000', help='comma separated media sizes in bytes')
+    parser.add_argument('--latency', type=float, default=0.01, help='mean seconds per fake API call')
+    parser.add_argument('--flood-rate', type=float, default=0.0005, help='share of API calls answered with a FloodWait')
+    parser.add_argument('--flood-seconds', type=int, default=1, help='length of injected FloodWaits')
+    parser.add_argument('--api-limits', action='store_true', help="keep the bot's outbound rate limits (off by default)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as a regression')
+    return parser.parse_args()
+
+def load_bot():
+    """Import bot.py in a scratch directory so its session and caches don't touch the real ones"""
+    os.environ.setdefault('API_ID', '1')
+    os.environ.setdefault('API_HASH', 'bench')
+    os.environ.setdefault('BOT_TOKEN', 'bench')
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    os.environ['SHARD_WORKERS'] = '0'
+    os.environ.pop('METRICS_PORT', None)
+    os.environ.pop('SESSION_STRING', None)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix='bench-'))
+    import bot
+    return bot
+
+class FakeClient:
+    """Answers the TelegramClient calls bot.py makes, after a simulated network delay"""
+
+    def __init__(self, bot, args, rng):
+        from telethon.tl import types
+
+        self.bot = bot
+        self.types = types
+        self.Message = types.Message  # the class Telethon returns, which can be serialized
+        self.args = args
+        self.rng = rng
+        self.calls = collections.Counter()
+        self.delivered = collections.defaultdict(collections.deque)  # chat_id -> futures waiting for a delivery
+        self.media_sizes = [int(size) for size in args.media_sizes.split(',')]
+        self.channels = {
+            f'channel{index}': types.Channel(
+                id=1000 + index,
+                title=f'channel{index}',
+                photo=types.ChatPhotoEmpty(),
+                date=None,
+                access_hash=index * 7919,
+                username=f'channel{index}',
+                noforwards=rng.random() < args.protected
+            )
+            for index in range(args.channels)
+        }
+        self.channels_by_id = {channel.id: channel for channel in self.channels.values()}
+        self.subscribed = {}  # user_id -> bool, decided on first check
+        self.part = bytes(bot.TRANSFER_PART_SIZE)  # one buffer shared by every downloaded part
+        self.sent_ids = itertools.count(1)
+
+    async def _call(self, method):
+        self.calls[method] += 1
+        await asyncio.sleep(self.rng.expovariate(1 / self.args.latency) if self.args.latency else 0)
+        if self.rng.random() < self.args.flood_rate:
+            from telethon.errors import FloodWaitError
+            raise FloodWaitError(None, capture=self.args.flood_seconds)
+
+    def _deliver(self, chat_id):
+        waiting = self.delivered.get(chat_id)
+        while waiting:
+            future = waiting.popleft()
+            if not future.done():
+                future.set_result(time.perf_counter())
+                return
+
+    def _post(self, channel, message_id):
+        # Posts are derived from their id so every fetch of a post sees the same content
+        post_rng = random.Random(channel.id * 1000003 + message_id)
+        if post_rng.random() < 0.02:
+            return None  # deleted post
+        media = None
+        if post_rng.random() < self.args.media:
+            media = self.types.MessageMediaDocument(document=self.types.Document(
+                id=channel.id * 1000003 + message_id,
+                access_hash=1,
+                file_reference=b'',
+                date=None,
+                mime_type='video/mp4',
+                size=post_rng.choice(self.media_sizes),
+                dc_id=2,
+                attributes=[]
+            ))
+        message = self.Message(
+            id=message_id,
+            peer_id=self.types.PeerChannel(channel.id),
+            date=None,
+            message=f'post {message_id}',
+            media=media
+        )
+        message._chat = channel
+        return message
+
+    def _sent(self, chat_id, media=None):
+        if media is not None and not isinstance(media, self.types.MessageMediaDocument):
+            # Uploaded media comes back as a normal document
+            media = self.types.MessageMediaDocument(document=self.types.Document(
+                id=next(self.sent_ids), access_hash=1, file_reference=b'', date=None,
+                mime_type='video/mp4', size=self.media_sizes[0], dc_id=2, attributes=[]
+            ))
+        return self.Message(
+            id=next(self.sent_ids),
+            peer_id=self.types.PeerUser(chat_id),
+            date=None,
+            message='',
+            media=media
+        )
+
+    async def get_entity(self, target):
+        await self._call('get_entity')
+        if isinstance(target, self.types.PeerChannel):
+            return self.channels_by_id[target.channel_id]
+        if target == self.bot.CHANNEL_USERNAME:
+            return self.types.Channel(
+                id=1, title=target, photo=self.types.ChatPhotoEmpty(), date=None, access_hash=1
+            )
+        channel = self.channels.get(target.lower())
+        if channel is None:
+            raise ValueError(f'No user has "{target}" as username')
+        return channel
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        await self._call('get_messages')
+        channel = self.channels_by_id.get(getattr(entity, 'channel_id', None))
+        if channel is None:
+            return []
+        if isinstance(ids, list):
+            return [self._post(channel, message_id) for message_id in ids]
+        return self._post(channel, ids)
+
+    async def forward_messages(self, entity, messages, *args, **kwargs):
+        await self._call('forward_messages')
+        if messages and messages[0].chat.noforwards:
+            from telethon.errors import ChatForwardsRestrictedError
+            raise ChatForwardsRestrictedError(None)
+        self._deliver(entity)
+        return [self._sent(entity) for _ in messages]
+
+    async def send_message(self, entity, message, *args, **kwargs):
+        await self._call('send_message')
+        media = getattr(message, 'media', None)
+        if media is not None and message.chat is not None and message.chat.noforwards:
+            from telethon.errors import ChatForwardsRestrictedError
+            raise ChatForwardsRestrictedError(None)
+        self._deliver(entity)
+        return self._sent(entity, media)
+
+    async def send_file(self, entity, file, *args, **kwargs):
+        await self._call('send_file')
+        self._deliver(entity)
+        if isinstance(file, list):
+            return [self._sent(entity, media) for media in file]
+        return self._sent(entity, file)
+
+    async def iter_download(self, media, **kwargs):
+        await self._call('download_part')
+        yield self.part
+
+    async def __call__(self, request):
+        from telethon.tl.functions.channels import GetParticipantRequest
+        from telethon.errors import UserNotParticipantError
+
+        await self._call(type(request).__name__)
+        if isinstance(request, GetParticipantRequest):
+            user_id = request.participant
+            subscribed = self.subscribed.get(user_id)
+            if subscribed is None:
+                subscribed = self.subscribed[user_id] = self.rng.random() < self.args.subscribed
+            if not subscribed:
+                raise UserNotParticipantError(None)
+            return self.types.channels.ChannelParticipant(
+                participant=self.types.ChannelParticipant(user_id=user_id, date=None), chats=[], users=[]
+            )
+        return True  # SaveFilePartRequest and SaveBigFilePartRequest
+
+class FakeEvent:
+    """The parts of a NewMessage event the router and handlers use"""
+
+    is_private = True
+
+    def __init__(self, client, user, message_id, text):
+        self.client = client
+        self.user = user
+        self.chat_id = user.id
+        self.id = message_id
+        self.text = text
+        self.date = datetime.datetime.now(datetime.timezone.utc)  # live, not caught up after an outage
+
+    async def get_sender(self):
+        return self.user
+
+    async def respond(self, *args, **kwargs):
+        await self.client._call('respond')
+
+def make_traffic(args, rng, users):
+    """Yield (user, text, expects_delivery) for each synthetic message"""
+    channel_names = [f'channel{index}' for index in range(args.channels)]
+    # Users take turns so none of them trips the per-user command rate limit
+    order = list(users)
+    rng.shuffle(order)
+    for index in range(args.requests):
+        user = order[index % len(order)]
+        kind = rng.random()
+        channel = rng.choice(channel_names)
+        if kind < 0.65:
+            text = f'https://t.me/{channel}/{rng.randint(1, 5000)}'
+        elif kind < 0.8:
+            posts = rng.sample(range(1, 5000), rng.randint(2, 5))
+            text = ' '.join(f'https://t.me/{channel}/{post}' for post in posts)
+        elif kind < 0.9:
+            text = '/start'
+        elif kind < 0.97:
+            text = '/help'
+        else:
+            text = 'hello there'
+        yield user, text, text.startswith('https://')
+
+async def replay(bot, client, args, rng):
+    from telethon.tl.types import User
+
+    users = [User(id=100000 + index, first_name=f'user{index}', bot=False) for index in range(args.users)]
+    latencies = []
+    unanswered = 0
+    started = time.perf_counter()
+
+    async def run_request(event, expects_delivery):
+        nonlocal unanswered
+        sent_at = time.perf_counter()
+        delivered = None
+        if expects_delivery:
+            delivered = asyncio.get_running_loop().create_future()
+            client.delivered[event.chat_id].append(delivered)
+        await bot.router(event)
+        if delivered is None:
+            latencies.append(time.perf_counter() - sent_at)
+            return
+        try:
+            # Unsubscribed users only get the subscribe prompt, so nothing is delivered
+            if client.subscribed.get(event.user.id) is False:
+                delivered.cancel()
+                latencies.append(time.perf_counter() - sent_at)
+                return
+            latencies.append(await asyncio.wait_for(delivered, 60) - sent_at)
+        except asyncio.TimeoutError:
+            unanswered += 1
+
+    tasks = []
+    for index, (user, text, expects_delivery) in enumerate(make_traffic(args, rng, users)):
+        # Open loop: messages arrive on schedule whether or not the bot keeps up
+        delay = started + index / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        event = FakeEvent(client, user, index + 1, text)
+        tasks.append(asyncio.create_task(run_request(event, expects_delivery)))
+    await asyncio.gather(*tasks)
+    return latencies, unanswered, time.perf_counter() - started
+
+async def micro_benchmarks(bot):
+    """Operations per second of the per-message hot paths"""
+    results = {}
+
+    count = 200000
+    started = time.perf_counter()
+    for index in range(count):
+        await bot.check_cooldown(index % 50000)
+    results['check_cooldown_ops'] = count / (time.perf_counter() - started)
+
+    for user_id in range(10000):
+        bot.subscription_cache.set(user_id, True)
+    started = time.perf_counter()
+    for index in range(count):
+        await bot.is_user_subscribed(index % 10000)
+    results['is_user_subscribed_ops'] = count / (time.perf_counter() - started)
+    return results
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+async def run(bot, args):
+    rng = random.Random(args.seed)
+    client = FakeClient(bot, args, rng)
+    bot.client = client
+    if not args.api_limits:
+        # Measure the bot itself rather than Telegram's rate limits
+        for bucket in bot.api_limiter._buckets.values():
+            bucket.rate = bucket.capacity = bucket.tokens = 1e9
+    bot.link_scheduler.start()
+
+    memory_before = rss_mb()
+    latencies, unanswered, elapsed = await replay(bot, client, args, rng)
+    memory_after = rss_mb()
+    latencies.sort()
+
+    results = {
+        'requests': args.requests,
+        'answered': len(latencies),
+        'unanswered': unanswered,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else 0.0,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else 0.0,
+        'api_calls_per_request': sum(client.calls.values()) / args.requests,
+        'memory_growth_mb': memory_after - memory_before,
+        'api_calls': dict(client.calls.most_common()),
+        'flood_waits': bot.api_limiter.flood_waits,
+    }
+    results.update(await micro_benchmarks(bot))
+    return results
+
+def report(results, baseline, tolerance):
+    """Print the results next to the baseline and return True if nothing regressed"""
+    print(f"{results['requests']} messages in {results['seconds']:.1f}s, "
+          f"{results['unanswered']} unanswered, {results['flood_waits']} FloodWaits")
+    print(f"API calls: {results['api_calls']}")
+    print()
+    print(f"{'metric':<26}{'result':>14}{'baseline':>14}{'change':>10}")
+    ok = True
+    for name, higher_is_better in COMPARED.items():
+        value = results[name]
+        line = f"{name:<26}{value:>14.2f}"
+        if baseline and name in baseline:
+            base = baseline[name]
+            change = (value - base) / base if base else 0.0
+            worse = -change if higher_is_better else change
+            flag = '  REGRESSION' if worse > tolerance and abs(value - base) > 0.01 else ''
+            ok = ok and not flag
+            line += f"{base:>14.2f}{change:>+10.1%}{flag}"
+        print(line)
+    return ok
+
+def main():
+    args = parse_args()
+    bot = load_bot()
+    results = asyncio.run(run(bot, args))
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    ok = report(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"\nSaved baseline to {args.baseline}")
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
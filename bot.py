@@ -1,38 +1,72 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # startup timings are measured from here
 import logging
 import re
 import os
 import asyncio
-import nest_asyncio
-import time
+import contextvars
+import json
 import random
-import string
+import signal
 import sqlite3
-from telethon import TelegramClient, events, Button
-from telethon.tl.functions.messages import GetMessagesRequest
-from telethon.tl.types import InputPeerChannel, InputPeerUser, InputPeerChat
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from array import array
+from collections import OrderedDict, deque
+from telethon import TelegramClient, events, Button, helpers, utils
+from telethon.sessions import SQLiteSession, StringSession
+from telethon.tl.types import (
+    Channel,
+    ChannelParticipantBanned,
+    ChannelParticipantLeft,
+    Document,
+    DocumentAttributeFilename,
+    InputFile,
+    InputFileBig,
+    InputMediaUploadedDocument,
+    InputMediaUploadedPhoto,
+    InputPeerChannel,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    Photo,
+    PhotoSize,
+    PhotoSizeProgressive,
+    PeerChannel,
+    UpdateChannelParticipant
+)
 from telethon.errors import (
+    ChannelInvalidError,
     ChannelPrivateError, 
+    ChannelPublicGroupNaError,
+    ChatForwardsRestrictedError,
     FloodWaitError, 
-    MessageTooLongError,
-    MediaEmptyError,
     FilePartsInvalidError,
     FileReferenceExpiredError,
+    PeerIdInvalidError,
     UserNotParticipantError,
-    ConnectionError,
-    ServerError
+    UsernameInvalidError,
+    UsernameNotOccupiedError,
+    ServerError,
+    RPCError
 )
 from telethon.tl.functions.channels import GetParticipantRequest
+from telethon.tl.functions.updates import GetStateRequest
+from telethon.extensions import BinaryReader
 from dotenv import load_dotenv
+import archive
+import logs
+import metrics
 
 # Load environment variables
 load_dotenv()
 
-# Enable logging with more detailed format
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+# Enable logging (see logs.py for the LOG_* settings)
+logs.configure()
+logger = logging.getLogger('bot')
+# Subsystems with their own logger, so LOG_LEVELS can tune them separately
+fetch_logger = logging.getLogger('bot.fetch')
+delivery_logger = logging.getLogger('bot.delivery')
+subscription_logger = logging.getLogger('bot.subscription')
 
 # Get API credentials from environment variables
 API_ID = int(os.getenv('API_ID'))
@@ -43,184 +77,1557 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not all([API_ID, API_HASH, BOT_TOKEN]):
     raise ValueError("Missing required environment variables. Please set API_ID, API_HASH, and BOT_TOKEN")
 
-def cleanup_all_sessions():
-    """Delete all session files"""
-    try:
-        for file in os.listdir('.'):
-            if file.endswith('.session'):
-                try:
-                    os.remove(file)
-                    logger.info(f"Removed session file: {file}")
-                except Exception as e:
-                    logger.error(f"Error removing session file {file}: {e}")
-    except Exception as e:
-        logger.error(f"Error in cleanup_all_sessions: {e}")
+# Sharded mode (see sharding.py)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 0))  # worker processes for fetch/forward jobs, 0 to run them here
+SHARD_WORKER_CONCURRENCY = int(os.getenv('SHARD_WORKER_CONCURRENCY', 8))  # jobs a worker process runs at once
+SHARD_ID = os.getenv('SHARD_ID')  # set inside worker processes only
+
+USE_UVLOOP = os.getenv('USE_UVLOOP', '1') == '1'  # use uvloop when it's installed
 
-def generate_session_name():
-    """Generate a unique session name"""
-    return f'bot_session_{random.randint(1000, 9999)}'
+SESSION_NAME = os.getenv('SESSION_NAME', 'bot')  # session file name, without the .session extension
+SESSION_STRING = os.getenv('SESSION_STRING')  # StringSession snapshot, used instead of the session file when set
+CATCH_UP = os.getenv('CATCH_UP', '1') == '1'  # on connect, fetch the messages sent while the bot was offline
 
-# Clean up any existing sessions before starting
-cleanup_all_sessions()
+class WalSession(SQLiteSession):
+    """SQLite session file opened in WAL mode.
 
-# Initialize the client with a unique session name
-session_name = generate_session_name()
-client = TelegramClient(session_name, API_ID, API_HASH)
+    The file is kept between runs, so restarts and reconnects reuse the
+    authorized key and the cached entities instead of logging in again.
+    """
 
-# Apply nest_asyncio to allow nested event loops
-nest_asyncio.apply()
+    def _cursor(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, timeout=10, check_same_thread=False)
+            if self.filename != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('PRAGMA synchronous=NORMAL')
+        return self._conn.cursor()
+
+def create_session():
+    """Return the session for this process"""
+    # Shard workers log in separately, so each one keeps its own file
+    if SHARD_ID is not None:
+        return WalSession(f'{SESSION_NAME}_shard{SHARD_ID}')
+    if SESSION_STRING:
+        return StringSession(SESSION_STRING)
+    return WalSession(SESSION_NAME)
+
+# Flood waits are handled by api_limiter instead of Telethon's built-in sleep,
+# so every call that can get one goes through the limiter.
+# Shard workers only run jobs, so they don't take updates away from the dispatcher.
+# With catch_up, Telethon gets the difference from the update state saved in the session.
+client = TelegramClient(
+    create_session(),
+    API_ID,
+    API_HASH,
+    flood_sleep_threshold=0,
+    receive_updates=SHARD_ID is None,
+    catch_up=CATCH_UP and SHARD_ID is None
+)
+
+# Metrics settings (see metrics.py)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # interface the metrics endpoint listens on
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # port of the /metrics endpoint, 0 to disable it
+METRICS_FILE = os.getenv('METRICS_FILE')  # file the metrics are written to periodically, if set
+METRICS_DUMP_INTERVAL = int(os.getenv('METRICS_DUMP_INTERVAL', 15))  # seconds between writes of METRICS_FILE
+
+update_seconds = metrics.registry.histogram(
+    'bot_update_seconds', 'Time spent handling an incoming message')
+command_seconds = metrics.registry.histogram(
+    'bot_command_seconds', 'Time spent in command handlers', ('command',))
+subscription_check_seconds = metrics.registry.histogram(
+    'bot_subscription_check_seconds', 'Time to answer a subscription check', ('result',))
+entity_lookups = metrics.registry.counter(
+    'bot_entity_lookups_total', 'Channel lookups by where they were answered', ('source',))
+entity_resolve_seconds = metrics.registry.histogram(
+    'bot_entity_resolve_seconds', 'Time to resolve a channel over the network')
+fetch_seconds = metrics.registry.histogram(
+    'bot_fetch_seconds', 'Latency of each fetch strategy', ('strategy', 'kind', 'result'))
+delivery_seconds = metrics.registry.histogram(
+    'bot_delivery_seconds', 'Time to deliver the messages of a job', ('method',))
+flood_wait_seconds = metrics.registry.counter(
+    'bot_flood_wait_seconds_total', 'Seconds of FloodWait received', ('method',))
+
+# Children used on hot paths, looked up once
+SUBSCRIBED_SECONDS = subscription_check_seconds.labels('subscribed')
+NOT_SUBSCRIBED_SECONDS = subscription_check_seconds.labels('not_subscribed')
+ENTITY_LOOKUPS_CACHE = entity_lookups.labels('cache')
+ENTITY_LOOKUPS_NETWORK = entity_lookups.labels('network')
+FORWARD_SECONDS = delivery_seconds.labels('forward')
+RESEND_SECONDS = delivery_seconds.labels('resend')
 
 CHANNEL_USERNAME = 'morsh_bots'  # without @
 
-# Store last message time for each user
-last_message_time = {}
-MESSAGE_COOLDOWN = 5  # seconds between messages
 MAX_MESSAGES_PER_MINUTE = 10  # maximum messages per minute per user
-message_count = {}  # track message count per user
-MAX_CONCURRENT_USERS = 1000  # maximum number of concurrent users
-active_users = set()  # track active users
 
-# Add this at the top of the file, after the imports
-COMMAND_HANDLERS = set()
+# Per-command rate limits: command -> (requests, period in seconds, burst)
+# Requests are spaced period / requests apart, with up to `burst` allowed back to back.
+COMMAND_RATE_LIMITS = {
+    'default': (MAX_MESSAGES_PER_MINUTE, 60, 1),
+    'check_sub': (10, 60, 3),
+    '/range': (3, 600, 1),
+    '/search': (5, 60, 2),
+}
+RATE_LIMIT_MAX_USERS = int(os.getenv('RATE_LIMIT_MAX_USERS', 2000000))  # tracked users per command
+TIMER_WHEEL_SIZE = 1024  # one-second slots in the rate limit expiry wheel
+
+# Channel part of a post link: a username, or c/<id> for private channels
+CHANNEL_PATTERN = r'(c/\d+|[A-Za-z][A-Za-z0-9_]{3,31})'
+# Regular expression to match Telegram channel post links, including topic links (t.me/channel/<topic>/<post>)
+LINK_PATTERN = re.compile(rf'https?://t\.me/{CHANNEL_PATTERN}/(?:\d+/)?(\d+)')
+MAX_LINKS_PER_MESSAGE = 200  # links per channel taken from a single message
+MAX_IDS_PER_REQUEST = 100  # Telegram's limit for get_messages and forward_messages
+
+# Post range settings
+RANGE_PATTERN = re.compile(rf'https?://t\.me/{CHANNEL_PATTERN}/(\d+)-(\d+)')
+RANGE_COMMAND_PATTERN = re.compile(rf'/range\s+https?://t\.me/{CHANNEL_PATTERN}/(\d+)(?:-|\s+)(\d+)')
+MAX_RANGE_SIZE = int(os.getenv('MAX_RANGE_SIZE', 5000))  # posts allowed in a single range
+RANGE_PAGE_SIZE = 100  # posts fetched and delivered per batch
+active_ranges = {}  # user_id -> RangeJob that is queued or running
+paused_ranges = {}  # user_id -> RangeJob that was cancelled or failed part way
+
+# Message cache settings
+MESSAGE_CACHE_TTL = int(os.getenv('MESSAGE_CACHE_TTL', 30))  # seconds a fetched post is reused for other users
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', 5000))  # posts kept in the message cache
+
+# Archive settings (see archive.py)
+ARCHIVE_FILE = os.getenv('ARCHIVE_FILE')  # database of fetched posts, shared with shard workers; unset to disable
+ARCHIVE_MAX_MB = int(os.getenv('ARCHIVE_MAX_MB', 1024))  # post data kept before the oldest posts are evicted
+ARCHIVE_MAX_AGE = int(os.getenv('ARCHIVE_MAX_AGE', 24 * 3600))  # seconds an archived post answers repeat requests
+ARCHIVE_SEARCH_RESULTS = 10  # matches listed by /search
+
+# Delivery cache settings
+DELIVERY_CACHE_SIZE = int(os.getenv('DELIVERY_CACHE_SIZE', 20000))  # media posts whose delivered copy is remembered
+
+# Repeated request settings
+RECENT_REPLY_SIZE = int(os.getenv('RECENT_REPLY_SIZE', 100000))  # (user, post) pairs remembered
+RECENT_DELIVERY_TTL = int(os.getenv('RECENT_DELIVERY_TTL', 600))  # seconds a repeated link gets a reply to the earlier copy, 0 to always resend
+
+# Media transfer settings, used to copy protected content
+TRANSFER_PART_SIZE = 512 * 1024  # Telegram's maximum file part size
+TRANSFER_BIG_FILE_SIZE = 10 * 1024 * 1024  # files above this size use the big file upload methods
+TRANSFER_CONNECTIONS = int(os.getenv('TRANSFER_CONNECTIONS', 4))  # parts downloaded and uploaded in parallel
+TRANSFER_BUFFERED_PARTS = int(os.getenv('TRANSFER_BUFFERED_PARTS', 8))  # downloaded parts waiting for upload
+TRANSFER_PART_RETRIES = 3  # attempts for each part before the transfer fails
+
+# Link job scheduler settings
+# In sharded mode a worker only waits for a shard, so there is one for each job the shards can run
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', SHARD_WORKERS * SHARD_WORKER_CONCURRENCY or 8))  # async workers fetching and forwarding links
+MAX_FETCHES_PER_CHANNEL = int(os.getenv('MAX_FETCHES_PER_CHANNEL', 2))  # concurrent upstream fetches per source channel
+MAX_RANGES_PER_CHANNEL = int(os.getenv('MAX_RANGES_PER_CHANNEL', 1))  # concurrent ranges per source channel, on top of the jobs
+MAX_RUNNING_RANGES = int(os.getenv('MAX_RUNNING_RANGES', max(1, WORKER_COUNT // 2)))  # ranges running at once, so links keep some workers
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', 5000))  # waiting jobs before new links are rejected
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', 10))  # waiting jobs per user
+QUEUE_NOTICE_SECONDS = int(os.getenv('QUEUE_NOTICE_SECONDS', 10))  # expected wait from which a user is told their link is queued
+
+# Router settings
+TEXT_MESSAGE = 'text'  # command table key for messages that are not commands
+commands = {}  # command -> (handler, rate limit name, subscribers only)
+router_hooks = []  # callables run as hook(command, seconds) after each dispatch
+command_histograms = {}  # command -> bot_command_seconds child
+
+# Shown to users who haven't joined CHANNEL_USERNAME yet
+SUBSCRIBE_MESSAGE = (
+    "🚫 To use this bot, you must subscribe to our channel first:\n"
+    "👉 [Join Morsh Bots](https://t.me/morsh_bots)\n\n"
+    "After joining, click the 'Check Subscription' button below to verify:"
+)
+SUBSCRIBE_BUTTONS = [
+    [Button.url("📢 Join Channel", "https://t.me/morsh_bots")],
+    [Button.inline("✅ Check Subscription", b"check_sub")]
+]
+
+# Responses of the static commands, built once
+WELCOME_MESSAGE = (
+    '👋 Welcome {first_name}!\n\n'
+    '🔒 I can help you save and forward content from any Telegram channel.\n\n'
+    '📥 Just send me a Telegram channel post link\n'
+    'and I will fetch its content for you.\n'
+    'Private channel links (t.me/c/...) work for channels I am a member of.\n\n'
+    'Use /help to see all available commands.'
+)
+HELLO_MESSAGE = (
+    '👋 Hello {first_name}!\n\n'
+    'I\'m your content saving assistant. How can I help you today?'
+)
+HELP_MESSAGE = (
+    '🔒 Save Restricted Content Bot\n\n'
+    '📥 Save and forward content from any Telegram channel\n'
+    '🔓 Access restricted content easily\n'
+    '📱 Works with private and public channels\n'
+    '⚡ Fast and reliable content delivery\n\n'
+    'Commands:\n'
+    '/start - Start using the bot\n'
+    '/help - Show this help message\n'
+    '/hello - Get a friendly greeting\n'
+    '/range <link> <last id> - Send a range of posts\n'
+    '/cancel - Stop the current range\n'
+    '/resume - Continue a stopped range\n'
+    '/search <words> - Find posts the bot has already fetched from public channels\n\n'
+    'How to use:\n'
+    '1. Send me a Telegram channel post link\n'
+    '2. I will fetch and forward the content to you\n\n'
+    'Note: Some channels may have restrictions'
+)
+ALREADY_SENT_MESSAGE = '⬆️ I sent you this a moment ago.'
+
+# Update deduplication settings
+DEDUP_WINDOW_SIZE = int(os.getenv('DEDUP_WINDOW_SIZE', 20000))  # most updates remembered at once
+DEDUP_RETENTION = int(os.getenv('DEDUP_RETENTION', 900))  # seconds an update is remembered
+
+class DedupWindow:
+    """Fixed-size ring buffer plus hash map of recently handled (chat_id, msg_id) pairs.
+
+    Message ids are only unique within a chat, so the chat id is part of the key.
+    Memory is fixed by the ring size; entries also expire after `retention` seconds.
+    """
+
+    def __init__(self, size, retention):
+        self.retention = retention
+        self._ring = [None] * size  # slot -> key stored there
+        self._seen = {}  # key -> (seen_at, slot)
+        self._next = 0
+        self.checked = 0
+        self.duplicates = 0
+
+    def seen(self, chat_id, msg_id):
+        """Return True if the update was handled recently, otherwise remember it"""
+        self.checked += 1
+        key = (chat_id, msg_id)
+        now = time.monotonic()
+
+        entry = self._seen.get(key)
+        if entry is not None and now - entry[0] < self.retention:
+            self.duplicates += 1
+            return True
+
+        # Reuse the oldest slot, forgetting the key that was stored there
+        slot = self._next
+        old_key = self._ring[slot]
+        if old_key is not None and self._seen.get(old_key, (0, None))[1] == slot:
+            del self._seen[old_key]
+        self._ring[slot] = key
+        self._seen[key] = (now, slot)
+        self._next = (slot + 1) % len(self._ring)
+        return False
+
+    def stats(self):
+        """Return duplicate hit counters and the number of remembered updates"""
+        return {
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'size': len(self._seen),
+        }
+
+recent_updates = DedupWindow(DEDUP_WINDOW_SIZE, DEDUP_RETENTION)
+
+# Catch-up settings
+CATCH_UP_RATE = float(os.getenv('CATCH_UP_RATE', 10))  # missed messages handled per second after an outage
+CATCH_UP_BURST = 10  # missed messages handled back to back before the rate applies
+CATCH_UP_MAX_PER_USER = int(os.getenv('CATCH_UP_MAX_PER_USER', 5))  # missed messages handled per user, the rest are dropped
+CATCH_UP_SAVE_INTERVAL = 30  # seconds between update state saves, bounding what a crash replays
+
+# Outbound request limits: method class -> (requests per second, burst size)
+# Classes not listed here (users, participants, auth) are only paused by FloodWaits.
+API_RATE_LIMITS = {
+    'resolve': (1, 5),  # ResolveUsername has a very strict flood limit
+    'get_channel': (5, 10),  # channels looked up by id for c/<id> links, apart from the username resolves
+    'participant': (10, 20),
+    'get_messages': (20, 30),
+    'forward': (20, 30),
+    'send': (25, 30),
+    'callback': (30, 30),
+    'download': (50, 50),  # file parts
+    'upload': (50, 50),  # file parts
+}
+FLOOD_WAIT_MAX_RETRIES = 3  # times a call is retried after a FloodWait
+FLOOD_WAIT_MAX_SECONDS = 300  # longer FloodWaits are raised to the caller instead of waited out
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ApiLimiter:
+    """Rate limits outbound Telegram calls per method class and waits out FloodWaits per peer"""
+
+    def __init__(self, limits, max_retries, max_wait):
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._buckets = {method: TokenBucket(rate, burst) for method, (rate, burst) in limits.items()}
+        self._paused_until = {}  # (method, peer) -> monotonic time when calls may resume
+        self.throttled_seconds = 0.0  # total time calls spent waiting for the limiter
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    async def call(self, method, peer, func, *args, **kwargs):
+        """Run func(*args, **kwargs) under the limits for the given method class and peer.
+
+        peer is None for calls that are limited account-wide (such as resolving usernames).
+        """
+        return await self._call(method, peer, self.max_retries, func, args, kwargs)
+
+    async def call_once(self, method, peer, func, *args, **kwargs):
+        """Like call, but raise FloodWaitError instead of waiting out a FloodWait or a pause"""
+        return await self._call(method, peer, 0, func, args, kwargs)
+
+    async def _call(self, method, peer, max_retries, func, args, kwargs):
+        counter = outbound_calls.get()
+        for attempt in range(max_retries + 1):
+            await self._wait_turn(method, peer, max_retries > 0)
+            if counter is not None:
+                counter[0] += 1
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                self.flood_wait_seconds += e.seconds
+                flood_wait_seconds.labels(method).inc(e.seconds)
+                if e.seconds > self.max_wait:
+                    raise
+
+                # Only pause this method for this peer, everything else keeps running
+                self._paused_until[(method, peer)] = time.monotonic() + e.seconds
+                if attempt == max_retries:
+                    raise
+                logger.warning("FloodWait of %ss on %s for %s, retrying after the wait", e.seconds, method, peer)
+
+    def stats(self):
+        """Return throttling counters"""
+        return {
+            'throttled_seconds': self.throttled_seconds,
+            'flood_waits': self.flood_waits,
+            'flood_wait_seconds': self.flood_wait_seconds,
+            'paused': sum(1 for until in self._paused_until.values() if until > time.monotonic()),
+        }
+
+    async def _wait_turn(self, method, peer, wait):
+        started = time.monotonic()
+
+        # Honor any FloodWait on this peer or on the method as a whole
+        for key in ((method, peer), (method, None)):
+            until = self._paused_until.get(key)
+            if until is None:
+                continue
+            delay = until - time.monotonic()
+            if delay > 0:
+                if not wait:
+                    raise FloodWaitError(None, capture=int(delay) + 1)
+                await asyncio.sleep(delay)
+            else:
+                del self._paused_until[key]
+
+        bucket = self._buckets.get(method)
+        if bucket is not None:
+            await bucket.acquire()
+
+        self.throttled_seconds += time.monotonic() - started
+
+api_limiter = ApiLimiter(API_RATE_LIMITS, FLOOD_WAIT_MAX_RETRIES, FLOOD_WAIT_MAX_SECONDS)
+# [count] of the Telegram calls made by the current link job, tasks it starts included
+outbound_calls = contextvars.ContextVar('outbound_calls', default=None)
+
+class CatchUp:
+    """Paces the messages users sent while the bot was offline.
+
+    Telethon delivers the whole difference at once after a reconnect, so
+    messages dated before the connection are let through one at a time, in
+    the order they arrived, at a fixed rate. Live messages are not held up.
+    Each user gets at most max_per_user of them handled per connection.
+    """
+
+    def __init__(self, rate, burst, max_per_user):
+        self._bucket = TokenBucket(rate, burst)
+        self._turn = asyncio.Lock()  # FIFO, and only one waiter polls the bucket
+        self.max_per_user = max_per_user
+        self._per_user = {}  # user id -> missed messages let through since connecting
+        self.connected_at = time.time()  # in server time once connected, to compare with message dates
+        self.waiting = 0
+        self.replayed = 0
+        self.dropped = 0
+
+    def reset(self, connected_at):
+        """Start a new connection made at the given server time"""
+        self.connected_at = connected_at
+        self._per_user.clear()
+
+    def is_backlog(self, event):
+        """Return True for a message sent before the current connection was made"""
+        return event.date is not None and event.date.timestamp() < self.connected_at
+
+    def allow(self, user_id):
+        """Return True if another missed message of the user may be handled"""
+        count = self._per_user.get(user_id, 0)
+        if count >= self.max_per_user:
+            self.dropped += 1
+            return False
+        self._per_user[user_id] = count + 1
+        return True
+
+    async def admit(self):
+        """Wait for the turn of a missed message"""
+        self.waiting += 1
+        try:
+            async with self._turn:
+                await self._bucket.acquire()
+        finally:
+            self.waiting -= 1
+        self.replayed += 1
+
+    def stats(self):
+        """Return the missed messages waiting and handled so far"""
+        return {
+            'waiting': self.waiting,
+            'replayed': self.replayed,
+            'dropped': self.dropped,
+        }
+
+catch_up = CatchUp(CATCH_UP_RATE, CATCH_UP_BURST, CATCH_UP_MAX_PER_USER)
+
+async def save_update_state():
+    """Periodically write Telethon's update state to the session.
+
+    Telethon only saves it on disconnect, so after a crash the next start
+    would otherwise replay every update since the last clean shutdown.
+    """
+    # _save_states_and_entities is private Telethon API, as of the pinned 1.32.
+    # Without it the state is still saved on disconnect, just not in between.
+    if not hasattr(client, '_save_states_and_entities'):
+        logger.warning("This Telethon version can't save the update state periodically")
+        return
+    while True:
+        await asyncio.sleep(CATCH_UP_SAVE_INTERVAL)
+        if client.is_connected():
+            client._save_states_and_entities()
+            client.session.save()
+
+# Subscription status cache settings
+SUBSCRIBED_CACHE_TTL = 600  # seconds to trust a "subscribed" result
+NOT_SUBSCRIBED_CACHE_TTL = 30  # seconds to trust a "not subscribed" result
+SUBSCRIPTION_CACHE_SIZE = 50000  # maximum number of users kept in the cache
+
+class SubscriptionCache:
+    """LRU cache of subscription results with separate TTLs for positive and negative results"""
+
+    def __init__(self, max_size, subscribed_ttl, not_subscribed_ttl):
+        self.max_size = max_size
+        self.subscribed_ttl = subscribed_ttl
+        self.not_subscribed_ttl = not_subscribed_ttl
+        self._entries = OrderedDict()  # user_id -> (is_subscribed, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Return the cached status for a user, or None if missing or expired"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        subscribed, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[user_id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return subscribed
+
+    def set(self, user_id, subscribed):
+        """Store a subscription result, evicting the least recently used users if full"""
+        ttl = self.subscribed_ttl if subscribed else self.not_subscribed_ttl
+        self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Forget the cached status for a user"""
+        self._entries.pop(user_id, None)
+
+    def stats(self):
+        """Return hit/miss counters and the current cache size"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._entries),
+        }
+
+subscription_cache = SubscriptionCache(
+    SUBSCRIPTION_CACHE_SIZE,
+    SUBSCRIBED_CACHE_TTL,
+    NOT_SUBSCRIBED_CACHE_TTL
+)
+
+# Resolved entity cache settings
+ENTITY_CACHE_FILE = 'entity_cache.db' if SHARD_ID is None else f'entity_cache_shard{SHARD_ID}.db'  # survives restarts, also with a StringSession
+ENTITY_CACHE_TTL = 24 * 3600  # seconds before a cached entry is refreshed in the background
+ENTITY_CACHE_SIZE = 10000  # maximum number of usernames kept in the cache
+UNKNOWN_CHANNEL_TTL = 600  # seconds a c/<id> the bot can't see is refused without a lookup
+UNKNOWN_CHANNEL_CACHE_SIZE = 10000  # c/<id> keys remembered as unknown
+
+class EntityCache:
+    """Persistent username -> (id, access_hash) cache with TTL and LRU eviction.
+
+    Access hashes of private channels are kept apart, by channel id and without
+    a size limit: a private channel the bot can't look up by username is only
+    reachable while its access hash is known.
+    """
+
+    def __init__(self, path, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # username -> (id, access_hash, resolved_at)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entities ('
+            'username TEXT PRIMARY KEY, '
+            'id INTEGER NOT NULL, '
+            'access_hash INTEGER NOT NULL, '
+            'resolved_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS private_channels ('
+            'id INTEGER PRIMARY KEY, '
+            'access_hash INTEGER NOT NULL)'
+        )
+        # Move the c/<id> entries that earlier versions kept among the usernames
+        self._conn.execute(
+            'INSERT OR IGNORE INTO private_channels (id, access_hash) '
+            "SELECT id, access_hash FROM entities WHERE username LIKE 'c/%'"
+        )
+        self._conn.execute("DELETE FROM entities WHERE username LIKE 'c/%'")
+        self._conn.commit()
+        self._private = dict(self._conn.execute('SELECT id, access_hash FROM private_channels'))
+
+        # Load the most recently resolved entries into memory
+        rows = self._conn.execute(
+            'SELECT username, id, access_hash, resolved_at FROM entities '
+            'ORDER BY resolved_at DESC LIMIT ?',
+            (max_size,)
+        ).fetchall()
+        for username, entity_id, access_hash, resolved_at in reversed(rows):
+            self._entries[username] = (entity_id, access_hash, resolved_at)
+
+    def get(self, username):
+        """Return (id, access_hash, is_stale) for a username, or None if unknown"""
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        self._entries.move_to_end(username)
+        entity_id, access_hash, resolved_at = entry
+        return entity_id, access_hash, time.time() - resolved_at >= self.ttl
+
+    def set(self, username, entity_id, access_hash):
+        """Store a resolved entity in memory and on disk"""
+        resolved_at = time.time()
+        self._entries[username] = (entity_id, access_hash, resolved_at)
+        self._entries.move_to_end(username)
+        self._conn.execute(
+            'INSERT OR REPLACE INTO entities (username, id, access_hash, resolved_at) '
+            'VALUES (?, ?, ?, ?)',
+            (username, entity_id, access_hash, resolved_at)
+        )
+
+        # Evict the least recently used entries
+        evicted = []
+        while len(self._entries) > self.max_size:
+            evicted.append((self._entries.popitem(last=False)[0],))
+        if evicted:
+            self._conn.executemany('DELETE FROM entities WHERE username = ?', evicted)
+        self._conn.commit()
+
+    def invalidate(self, username):
+        """Forget a cached username"""
+        if self._entries.pop(username, None) is not None:
+            self._conn.execute('DELETE FROM entities WHERE username = ?', (username,))
+            self._conn.commit()
+
+    def get_private(self, channel_id):
+        """Return the access hash of a private channel, or None if unknown"""
+        return self._private.get(channel_id)
+
+    def set_private(self, channel_id, access_hash):
+        """Store a private channel's access hash in memory and on disk"""
+        if self._private.get(channel_id) == access_hash:
+            return
+        self._private[channel_id] = access_hash
+        self._conn.execute(
+            'INSERT OR REPLACE INTO private_channels (id, access_hash) VALUES (?, ?)',
+            (channel_id, access_hash)
+        )
+        self._conn.commit()
+
+entity_cache = EntityCache(ENTITY_CACHE_FILE, ENTITY_CACHE_TTL, ENTITY_CACHE_SIZE)
+refreshing_entities = set()  # usernames with a background refresh in progress
+resolving_entities = {}  # username -> task resolving it for the first time
+unknown_channels = OrderedDict()  # c/<id> key -> monotonic time until which its lookup isn't repeated
+
+# Channel member index settings
+MEMBER_SYNC_INTERVAL = 6 * 3600  # seconds between full re-syncs of the member set
+
+class ChannelMemberIndex:
+    """In-memory set of channel member ids, kept current by participant updates"""
+
+    def __init__(self):
+        self.channel_id = None
+        self.ready = False  # True once the first full sync has completed
+        self.synced_at = 0
+        self._members = set()
+
+    def __contains__(self, user_id):
+        return user_id in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def add(self, user_id):
+        self._members.add(user_id)
+
+    def discard(self, user_id):
+        self._members.discard(user_id)
+
+    def replace(self, channel_id, members):
+        """Swap in a freshly synced member set"""
+        self.channel_id = channel_id
+        self._members = members
+        self.ready = True
+        self.synced_at = time.time()
+
+channel_members = ChannelMemberIndex()
+
+async def send_message(chat_id, *args, **kwargs):
+    """Send a message through the API limiter"""
+    return await api_limiter.call('send', chat_id, client.send_message, chat_id, *args, **kwargs)
+
+async def respond(event, *args, **kwargs):
+    """Reply to an event through the API limiter"""
+    return await api_limiter.call('send', event.chat_id, event.respond, *args, **kwargs)
+
+def index_private_channel(channel_id, access_hash):
+    """Remember a channel's access hash for the private links (c/<id>) to it"""
+    entity_cache.set_private(channel_id, access_hash)
+
+def index_channel(entity):
+    """Add a channel entity without a username to the private channel index"""
+    # Min entities carry an access hash that can't be used on its own, and public
+    # channels can be resolved again, so they needn't grow the unbounded index
+    if (isinstance(entity, Channel) and not entity.min and entity.access_hash is not None
+            and not entity.username and not entity.usernames):
+        index_private_channel(entity.id, entity.access_hash)
+
+def cached_channel(key):
+    """Return the InputPeerChannel for a channel key if it is known without a lookup"""
+    if key.startswith('c/'):
+        channel_id = int(key[2:])
+        access_hash = entity_cache.get_private(channel_id)
+        return None if access_hash is None else InputPeerChannel(channel_id, access_hash)
+    cached = entity_cache.get(key)
+    return None if cached is None else InputPeerChannel(cached[0], cached[1])
+
+async def fetch_entity(username):
+    """Resolve a username over the network and store channels in the entity cache"""
+    if username.startswith('c/'):
+        # Private channels have no username, only the id from the link
+        target = PeerChannel(int(username[2:]))
+    else:
+        target = username
+    started = time.perf_counter()
+    method = 'get_channel' if isinstance(target, PeerChannel) else 'resolve'
+    entity = await api_limiter.call(method, None, client.get_entity, target)
+    entity_resolve_seconds.observe(time.perf_counter() - started)
+    if not isinstance(entity, Channel):
+        # Only channels are cached, anything else is returned as is
+        return entity
+
+    if username.startswith('c/'):
+        # Asked for by id, so keep it by id even if it has a username
+        index_private_channel(entity.id, entity.access_hash)
+    else:
+        index_channel(entity)
+        entity_cache.set(username.lower(), entity.id, entity.access_hash)
+    return InputPeerChannel(entity.id, entity.access_hash)
+
+async def refresh_entity(username):
+    """Refresh a stale entity cache entry in the background"""
+    try:
+        await fetch_entity(username)
+        fetch_logger.info("Refreshed cached entity for %s", username)
+    except Exception as e:
+        fetch_logger.warning("Could not refresh cached entity for %s: %s", username, e)
+    finally:
+        refreshing_entities.discard(username.lower())
+
+async def resolve_once(username):
+    """Resolve an uncached channel, letting concurrent callers share one lookup"""
+    key = username.lower()
+    task = resolving_entities.get(key)
+    if task is None:
+        ENTITY_LOOKUPS_NETWORK.inc()
+        task = asyncio.ensure_future(fetch_entity(username))
+        resolving_entities[key] = task
+        task.add_done_callback(lambda _: resolving_entities.pop(key, None))
+    # Shielded, so a caller that gives up doesn't cancel the lookup for the others
+    return await asyncio.shield(task)
+
+async def resolve_private_channel(key):
+    """Resolve a c/<id> key from the private channel index, or else from the session"""
+    channel = cached_channel(key)
+    if channel is not None:
+        # Access hashes of private channels come from updates and don't go stale
+        ENTITY_LOOKUPS_CACHE.inc()
+        return channel
+    
+    # Links to made-up or inaccessible ids would otherwise cost a lookup each time
+    until = unknown_channels.get(key)
+    if until is not None:
+        if until > time.monotonic():
+            raise ChannelPrivateError(None)
+        del unknown_channels[key]
+    try:
+        # get_entity(PeerChannel) knows the channels in the session and those the bot is in
+        return await resolve_once(key)
+    except (ValueError, ChannelPrivateError):
+        # The bot has never seen this channel, so it can't read from it
+        unknown_channels[key] = time.monotonic() + UNKNOWN_CHANNEL_TTL
+        while len(unknown_channels) > UNKNOWN_CHANNEL_CACHE_SIZE:
+            unknown_channels.popitem(last=False)
+        raise ChannelPrivateError(None)
+
+async def resolve_channel(username):
+    """Resolve a channel username, using the entity cache whenever possible"""
+    key = username.lower()
+    if key.startswith('c/'):
+        return await resolve_private_channel(key)
+    cached = entity_cache.get(key)
+    if cached is None:
+        return await resolve_once(username)
+
+    ENTITY_LOOKUPS_CACHE.inc()
+    entity_id, access_hash, stale = cached
+    if stale and key not in refreshing_entities:
+        # Serve the cached value now and refresh it without blocking the caller
+        refreshing_entities.add(key)
+        asyncio.create_task(refresh_entity(username))
+    return InputPeerChannel(entity_id, access_hash)
 
 async def is_user_subscribed(user_id):
+    # Answer from the cache when we have a fresh result
+    cached = subscription_cache.get(user_id)
+    if cached is not None:
+        return cached
+
     try:
         # Get the channel entity first
-        channel = await client.get_entity(CHANNEL_USERNAME)
-        logger.info(f"Checking subscription for user {user_id} in channel {channel.id}")
+        channel = await resolve_channel(CHANNEL_USERNAME)
+        subscription_logger.info("Checking subscription for user %s in channel %s", user_id, channel.channel_id)
         
         # Try different methods to check subscription
         try:
-            # Method 1: Using GetParticipantRequest
-            participant = await client(GetParticipantRequest(
+            # Method 1: Using GetParticipantRequest. With a synced member set to
+            # fall back on, a FloodWait isn't worth waiting for.
+            call = api_limiter.call_once if channel_members.ready else api_limiter.call
+            await call('participant', None, client, GetParticipantRequest(
                 channel=channel,
                 participant=user_id
             ))
-            logger.info(f"User {user_id} is subscribed (Method 1)")
+            subscription_logger.info("User %s is subscribed (Method 1)", user_id)
+            subscription_cache.set(user_id, True)
+            channel_members.add(user_id)
             return True
         except UserNotParticipantError:
-            logger.info(f"User {user_id} is not subscribed (Method 1)")
+            subscription_logger.info("User %s is not subscribed (Method 1)", user_id)
+            subscription_cache.set(user_id, False)
+            channel_members.discard(user_id)
             return False
         except Exception as e:
-            logger.error(f"Error in Method 1: {e}")
+            if isinstance(e, FloodWaitError):
+                subscription_logger.warning("Method 1 is paused by a FloodWait of %ss", e.seconds)
+            else:
+                subscription_logger.error("Error in Method 1: %s", e)
             
-            # Method 2: Try getting channel members
-            try:
-                participants = await client.get_participants(channel)
-                for participant in participants:
-                    if participant.id == user_id:
-                        logger.info(f"User {user_id} is subscribed (Method 2)")
-                        return True
-                logger.info(f"User {user_id} is not subscribed (Method 2)")
-                return False
-            except Exception as e2:
-                logger.error(f"Error in Method 2: {e2}")
+            # Method 2: Fall back to the locally synced member set
+            if not channel_members.ready:
+                subscription_logger.warning("Channel member set is not synced yet")
                 return False
+            subscribed = user_id in channel_members
+            subscription_logger.info("User %s is %s (Method 2)", user_id, 'subscribed' if subscribed else 'not subscribed')
+            return subscribed
                 
     except Exception as e:
-        logger.error(f"Error checking subscription: {e}")
+        subscription_logger.error("Error checking subscription: %s", e)
         return False
 
-async def check_cooldown(user_id):
-    current_time = time.time()
-    
-    # Initialize user's message tracking if not exists
-    if user_id not in message_count:
-        message_count[user_id] = {'count': 0, 'minute_start': current_time}
-    
-    # Reset count if a minute has passed
-    if current_time - message_count[user_id]['minute_start'] >= 60:
-        message_count[user_id] = {'count': 0, 'minute_start': current_time}
-    
-    # Check if user has exceeded message limit
-    if message_count[user_id]['count'] >= MAX_MESSAGES_PER_MINUTE:
-        return False
-    
-    # Check cooldown
-    if user_id in last_message_time:
-        time_diff = current_time - last_message_time[user_id]
-        if time_diff < MESSAGE_COOLDOWN:
+async def collect_members(channel):
+    """Return the ids of all members of a channel"""
+    return {user.id async for user in client.iter_participants(channel)}
+
+async def sync_channel_members():
+    """Build the channel member set once and re-sync it periodically"""
+    while True:
+        try:
+            channel = await resolve_channel(CHANNEL_USERNAME)
+            members = await api_limiter.call('participants', None, collect_members, channel)
+            channel_members.replace(channel.channel_id, members)
+            subscription_logger.info("Synced %s members of %s", len(members), CHANNEL_USERNAME)
+        except FloodWaitError as e:
+            # The sync is not time critical, so just wait and start over
+            subscription_logger.warning("FloodWait of %ss while syncing channel members", e.seconds)
+            await asyncio.sleep(e.seconds)
+            continue
+        except Exception as e:
+            subscription_logger.error("Error syncing channel members: %s", e)
+        await asyncio.sleep(MEMBER_SYNC_INTERVAL)
+
+@client.on(events.Raw)
+async def index_update_entities(update):
+    """Index the channels that come with updates so private links resolve without a lookup"""
+    # Bots can't list their dialogs, so updates are where private channels show up
+    entities = getattr(update, '_entities', None)
+    if entities:
+        for entity in entities.values():
+            index_channel(entity)
+
+@client.on(events.Raw(UpdateChannelParticipant))
+async def channel_participant_handler(update):
+    """Keep the member set current as users join or leave the channel"""
+    if update.channel_id != channel_members.channel_id:
+        return
+
+    participant = update.new_participant
+    if participant is None or isinstance(participant, (ChannelParticipantLeft, ChannelParticipantBanned)):
+        channel_members.discard(update.user_id)
+    else:
+        channel_members.add(update.user_id)
+    subscription_cache.invalidate(update.user_id)
+
+class RateLimiter:
+    """GCRA rate limiter with array-backed per-user state and timer-wheel expiry.
+
+    Each user costs one dict entry and one float. A user's state is dropped once
+    it has fully decayed, which the timer wheel finds without scanning all users.
+    """
+
+    __slots__ = ('interval', 'tolerance', 'max_users', 'limited', '_slots', '_tat', '_free', '_wheel', '_last_tick')
+
+    def __init__(self, requests, period, burst, max_users):
+        self.interval = period / requests
+        self.tolerance = self.interval * (burst - 1)  # how far ahead of now a user's state may run
+        self.max_users = max_users
+        self.limited = 0
+        self._slots = {}  # user_id -> index into _tat
+        self._tat = array('d')  # theoretical arrival time of each slot
+        self._free = []  # indexes of unused slots
+        self._wheel = [[] for _ in range(TIMER_WHEEL_SIZE)]  # user ids by the second their state decays
+        self._last_tick = int(time.monotonic())
+
+    def __len__(self):
+        return len(self._slots)
+
+    def allow(self, user_id, now=None):
+        """Record a request and return True if it is within the limit"""
+        if now is None:
+            now = time.monotonic()
+
+        slot = self._slots.get(user_id)
+        if slot is None:
+            if len(self._slots) >= self.max_users:
+                # Refuse new users rather than grow without bound under a flood
+                self.limited += 1
+                return False
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._tat)
+                self._tat.append(0.0)
+            self._slots[user_id] = slot
+            self._tat[slot] = now + self.interval
+            self._schedule(user_id, now + self.interval)
+            return True
+
+        tat = max(self._tat[slot], now)
+        if tat - now > self.tolerance:
+            self.limited += 1
             return False
-    
-    # Update tracking
-    last_message_time[user_id] = current_time
-    message_count[user_id]['count'] += 1
-    return True
+
+        self._tat[slot] = tat + self.interval
+        return True
+
+    def expire(self, now=None):
+        """Advance the timer wheel and free the slots of users whose state has decayed"""
+        if now is None:
+            now = time.monotonic()
+
+        tick = int(now)
+        first = max(self._last_tick + 1, tick - TIMER_WHEEL_SIZE + 1)
+        for second in range(first, tick + 1):
+            index = second % TIMER_WHEEL_SIZE
+            due = self._wheel[index]
+            self._wheel[index] = []
+            for user_id in due:
+                slot = self._slots.get(user_id)
+                if slot is None:
+                    continue
+                tat = self._tat[slot]
+                if tat <= now:
+                    del self._slots[user_id]
+                    self._free.append(slot)
+                else:
+                    # Still active, check again when its current state decays
+                    self._schedule(user_id, tat)
+        self._last_tick = tick
+
+    def _schedule(self, user_id, tat):
+        self._wheel[(int(tat) + 1) % TIMER_WHEEL_SIZE].append(user_id)
+
+rate_limiters = {
+    command: RateLimiter(requests, period, burst, RATE_LIMIT_MAX_USERS)
+    for command, (requests, period, burst) in COMMAND_RATE_LIMITS.items()
+}
+
+async def check_cooldown(user_id, command='default'):
+    """Return True if the user may run the command now"""
+    limiter = rate_limiters.get(command) or rate_limiters['default']
+    return limiter.allow(user_id)
 
 async def cleanup_inactive_users():
-    """Clean up inactive users periodically"""
+    """Drop the rate limit state of inactive users every second"""
     while True:
-        current_time = time.time()
-        # Remove users who haven't sent a message in the last 5 minutes
-        inactive_threshold = current_time - 300  # 5 minutes
-        for user_id in list(active_users):
-            if user_id in last_message_time and last_message_time[user_id] < inactive_threshold:
-                active_users.remove(user_id)
-                if user_id in message_count:
-                    del message_count[user_id]
-                if user_id in last_message_time:
-                    del last_message_time[user_id]
-        await asyncio.sleep(60)  # Check every minute
-
-async def cleanup_session():
-    """Clean up old session files"""
+        for limiter in rate_limiters.values():
+            limiter.expire()
+        await asyncio.sleep(1)
+
+def media_size(media):
+    """Return the size in bytes of a document or the largest size of a photo"""
+    document = getattr(media, 'document', None)
+    if isinstance(document, Document):
+        return document.size
+
+    photo = getattr(media, 'photo', None)
+    if isinstance(photo, Photo):
+        sizes = []
+        for size in photo.sizes:
+            if isinstance(size, PhotoSizeProgressive):
+                sizes.append(max(size.sizes))
+            elif isinstance(size, PhotoSize):
+                sizes.append(size.size)
+        return max(sizes, default=0)
+    return 0
+
+def delivery_key(message):
+    """Return the delivery cache key for a message whose media can be reused, or None"""
+    if isinstance(message.media, (MessageMediaDocument, MessageMediaPhoto)):
+        return message.chat_id, message.id
+    return None
+
+class DeliveredMedia:
+    """Media of a copy we delivered, plus where that copy lives so it can be refreshed"""
+
+    def __init__(self, input_media, chat_id, message_id, size):
+        self.input_media = input_media
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.size = size
+
+class DeliveryCache:
+    """LRU cache of delivered media keyed by (channel_id, message_id) of the source post"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (channel_id, message_id) -> DeliveredMedia
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.bytes_saved = 0
+
+    def get(self, key):
+        """Return the cached media for a source post, counting it as a hit or a miss"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.bytes_saved += entry.size
+        return entry
+
+    def peek(self, key):
+        """Return the cached media without touching the counters"""
+        return self._entries.get(key)
+
+    def set(self, key, sent_message):
+        """Remember the media of a delivered copy. Returns False if it has no reusable media"""
+        media = getattr(sent_message, 'media', None)
+        if not isinstance(media, (MessageMediaDocument, MessageMediaPhoto)):
+            return False
+
+        self._entries[key] = DeliveredMedia(
+            utils.get_input_media(media),
+            sent_message.chat_id,
+            sent_message.id,
+            media_size(media)
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return True
+
+    def invalidate(self, key):
+        """Forget the cached media for a source post"""
+        self._entries.pop(key, None)
+
+    def stats(self):
+        """Return hit rate, refresh count and bytes saved"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'refreshes': self.refreshes,
+            'bytes_saved': self.bytes_saved,
+            'size': len(self._entries),
+        }
+
+delivery_cache = DeliveryCache(DELIVERY_CACHE_SIZE)
+
+class RecentReplies:
+    """Bounded per-user memory of recent answers, so a repeat can be answered cheaply"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (user_id, key) -> (value, answered_at)
+        self.hits = 0
+        self.calls_avoided = 0
+
+    def get(self, user_id, key):
+        """Return what was remembered for this user and key, or None once it expired"""
+        entry = self._entries.get((user_id, key))
+        if entry is None or time.monotonic() - entry[1] >= self.ttl:
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, key, value):
+        self._entries[(user_id, key)] = (value, time.monotonic())
+        self._entries.move_to_end((user_id, key))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def forget(self, user_id, key):
+        self._entries.pop((user_id, key), None)
+
+    def stats(self):
+        """Return repeats answered, Telegram calls they saved and entries remembered"""
+        return {
+            'hits': self.hits,
+            'calls_avoided': self.calls_avoided,
+            'size': len(self._entries),
+        }
+
+# (user, (channel key, message id)) -> (id of the copy in the user's chat, calls sending it again would cost)
+recent_deliveries = RecentReplies(RECENT_DELIVERY_TTL, RECENT_REPLY_SIZE)
+
+def media_file_name(media):
+    """Return the file name to upload media under"""
+    document = getattr(media, 'document', None)
+    if isinstance(document, Document):
+        for attribute in document.attributes:
+            if isinstance(attribute, DocumentAttributeFilename):
+                return attribute.file_name
+        return 'file'
+    return 'photo.jpg'
+
+class TransferEngine:
+    """Copies media by downloading file parts in parallel and piping them straight into parallel uploads.
+
+    Memory use is bounded by the part queue: at most (buffered_parts + 2 * connections) parts
+    of TRANSFER_PART_SIZE bytes are held at any time, and nothing is written to disk.
+    """
+
+    def __init__(self, connections, buffered_parts, part_retries):
+        self.connections = connections
+        self.buffered_parts = buffered_parts
+        self.part_retries = part_retries
+        self.transfers = 0
+        self.bytes_transferred = 0
+        self.seconds = 0.0
+
+    async def upload_media(self, media):
+        """Download media and upload it again, returning an InputMedia ready to be sent"""
+        size = media_size(media)
+        if not size:
+            raise ValueError("Cannot transfer media of unknown size")
+
+        file_id = helpers.generate_random_long()
+        part_count = (size + TRANSFER_PART_SIZE - 1) // TRANSFER_PART_SIZE
+        is_big = size > TRANSFER_BIG_FILE_SIZE
+
+        started = time.monotonic()
+        await self._pipe(media, file_id, part_count, is_big)
+        elapsed = time.monotonic() - started
+
+        self.transfers += 1
+        self.bytes_transferred += size
+        self.seconds += elapsed
+        delivery_logger.info(
+            "Transferred %s bytes in %s parts in %.1fs (%.2f MB/s)",
+            size, part_count, elapsed, size / max(elapsed, 0.001) / 1024 / 1024
+        )
+
+        name = media_file_name(media)
+        if is_big:
+            input_file = InputFileBig(file_id, part_count, name)
+        else:
+            input_file = InputFile(file_id, part_count, name, '')
+
+        if isinstance(media, MessageMediaPhoto):
+            return InputMediaUploadedPhoto(input_file)
+        return InputMediaUploadedDocument(
+            file=input_file,
+            mime_type=media.document.mime_type,
+            attributes=media.document.attributes
+        )
+
+    def stats(self):
+        """Return transfer counters and the average throughput in bytes per second"""
+        return {
+            'transfers': self.transfers,
+            'bytes': self.bytes_transferred,
+            'seconds': self.seconds,
+            'throughput': self.bytes_transferred / self.seconds if self.seconds else 0.0,
+        }
+
+    async def _pipe(self, media, file_id, part_count, is_big):
+        parts = asyncio.Queue(maxsize=self.buffered_parts)
+        part_numbers = iter(range(part_count))
+
+        async def download():
+            for part in part_numbers:
+                data = await self._download_part(media, part)
+                await parts.put((part, data))
+
+        async def upload():
+            while True:
+                item = await parts.get()
+                if item is None:
+                    return
+                part, data = item
+                await self._upload_part(file_id, part, part_count, data, is_big)
+
+        downloaders = [asyncio.create_task(download()) for _ in range(self.connections)]
+        uploaders = [asyncio.create_task(upload()) for _ in range(self.connections)]
+
+        async def finish_downloads():
+            await asyncio.gather(*downloaders)
+            for _ in uploaders:
+                await parts.put(None)
+
+        try:
+            await asyncio.gather(finish_downloads(), *uploaders)
+        finally:
+            for task in downloaders + uploaders:
+                task.cancel()
+
+    async def _download_part(self, media, part):
+        async def fetch():
+            async for chunk in client.iter_download(
+                media,
+                offset=part * TRANSFER_PART_SIZE,
+                request_size=TRANSFER_PART_SIZE,
+                chunk_size=TRANSFER_PART_SIZE,
+                limit=1
+            ):
+                return chunk
+            return b''
+
+        for attempt in range(self.part_retries):
+            try:
+                return await api_limiter.call('download', None, fetch)
+            except (RPCError, OSError) as e:
+                if attempt == self.part_retries - 1:
+                    raise
+                delivery_logger.warning("Download of part %s failed, retrying: %s", part, e)
+
+    async def _upload_part(self, file_id, part, part_count, data, is_big):
+        # Only needed once media is copied, so not imported at startup
+        from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+
+        if is_big:
+            request = SaveBigFilePartRequest(file_id, part, part_count, data)
+        else:
+            request = SaveFilePartRequest(file_id, part, data)
+
+        for attempt in range(self.part_retries):
+            try:
+                if await api_limiter.call('upload', None, client, request):
+                    return
+                delivery_logger.warning("Upload of part %s was not saved, retrying", part)
+            except (RPCError, OSError) as e:
+                if attempt == self.part_retries - 1:
+                    raise
+                delivery_logger.warning("Upload of part %s failed, retrying: %s", part, e)
+        raise ValueError(f"Could not upload part {part} of {part_count}")
+
+transfer_engine = TransferEngine(TRANSFER_CONNECTIONS, TRANSFER_BUFFERED_PARTS, TRANSFER_PART_RETRIES)
+
+class LinkJob:
+    """Messages from one channel requested by a user in a single message"""
+
+    def __init__(self, user_id, chat_id, channel_username, message_ids, request_id=None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.channel_username = channel_username
+        self.message_ids = message_ids
+        # Id of the update that created the job, for the logs
+        self.request_id = request_id or logs.request_id.get()
+
+    @property
+    def channel_key(self):
+        return self.channel_username.lower()
+
+    def to_dict(self):
+        """Serialize the job for a shard worker or the pending jobs file"""
+        return {
+            'user_id': self.user_id,
+            'chat_id': self.chat_id,
+            'channel_username': self.channel_username,
+            'channel_key': self.channel_key,
+            'message_ids': list(self.message_ids),
+            'request_id': self.request_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['user_id'], data['chat_id'], data['channel_username'], data['message_ids'],
+            data.get('request_id')
+        )
+
+class RangeJob(LinkJob):
+    """A contiguous range of posts from one channel, delivered page by page"""
+
+    def __init__(self, user_id, chat_id, channel_username, first_id, last_id):
+        super().__init__(user_id, chat_id, channel_username, [])
+        self.first_id = first_id
+        self.last_id = last_id
+        self.next_id = first_id  # first post that has not been delivered yet
+        self.cancelled = False
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update(kind='range', first_id=self.first_id, last_id=self.last_id, next_id=self.next_id)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['user_id'], data['chat_id'], data['channel_username'], data['first_id'], data['last_id'])
+        job.next_id = data['next_id']
+        job.request_id = data.get('request_id')
+        return job
+
+def job_from_dict(data):
+    """Rebuild a LinkJob or RangeJob from its to_dict() form"""
+    if data.get('kind') == 'range':
+        return RangeJob.from_dict(data)
+    return LinkJob.from_dict(data)
+
+class LinkScheduler:
+    """Runs link jobs on a pool of workers with per-user FIFO queues.
+
+    Single links are only limited by the workers: the same post is usually
+    delivered to many different chats at once, and their fetches from the
+    channel are limited in fetch_messages. Ranges hold a worker until the
+    whole range is sent, so they are capped per channel and in total.
+    """
+
+    def __init__(self, handler, worker_count, max_queued, max_per_user,
+                 max_ranges_per_channel=1, max_ranges=1):
+        self.handler = handler
+        self.worker_count = worker_count
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.max_ranges_per_channel = max_ranges_per_channel
+        self.max_ranges = max_ranges
+        self._user_queues = {}  # user_id -> deque of waiting jobs
+        self._ready = deque()  # users with a waiting job and nothing running, in round-robin order
+        self._channel_running = {}  # slot key from _slots() -> number of running jobs
+        self._pending = 0
+        self._running = 0
+        self._running_jobs = set()
+        self._draining = False
+        self._condition = asyncio.Condition()
+        self._workers = []
+        self.job_seconds = 0.0  # moving average of how long a link job runs
+
+    def start(self):
+        """Start the worker pool unless it is already running"""
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def submit(self, job):
+        """Queue a job and return about how many jobs will start before it, or None if the queues are full"""
+        if self._pending >= self.max_queued:
+            return None
+
+        queue = self._user_queues.get(job.user_id)
+        if queue is None:
+            queue = deque()
+            self._user_queues[job.user_id] = queue
+            self._ready.append(job.user_id)
+        elif len(queue) >= self.max_per_user:
+            return None
+
+        queue.append(job)
+        self._pending += 1
+        position = self._position(job)
+
+        async with self._condition:
+            self._condition.notify()
+        return position
+
+    async def drain(self, timeout):
+        """Stop starting jobs and give the running ones up to timeout seconds to finish.
+
+        Returns the jobs that did not run to completion, running ones first,
+        and leaves the scheduler stopped.
+        """
+        self._draining = True
+        try:
+            async with self._condition:
+                await asyncio.wait_for(self._condition.wait_for(lambda: not self._running), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s jobs still running after %ss, stopping them", self._running, timeout)
+
+        unfinished = list(self._running_jobs)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for queue in self._user_queues.values():
+            unfinished.extend(queue)
+        return unfinished
+
+    def expected_wait(self, position):
+        """Return about how many seconds a job at this queue position waits to start"""
+        return position * self.job_seconds / self.worker_count
+
+    def queued(self, user_id):
+        """Return the number of jobs the user has waiting"""
+        queue = self._user_queues.get(user_id)
+        return len(queue) if queue else 0
+
+    def stats(self):
+        """Return queue depth and worker usage"""
+        return {
+            'pending': self._pending,
+            'running': self._running,
+            'users': len(self._user_queues),
+            'workers': len(self._workers),
+        }
+
+    def _slots(self, job):
+        """Return the (key, limit) pairs a job counts against while it runs"""
+        if isinstance(job, RangeJob):
+            return ((('range', job.channel_key), self.max_ranges_per_channel), (('range', None), self.max_ranges))
+        return ()
+
+    def _position(self, job):
+        """Return about how many jobs will start before a job just queued at the end of its user's queue"""
+        queue = self._user_queues[job.user_id]
+        ready = len(self._ready)
+        if job.user_id in self._ready:
+            # Each user ahead in the round robin starts a job before every one of ours
+            turns = self._ready.index(job.user_id) + (len(queue) - 1) * ready
+        else:
+            # One of the user's jobs is running, and the user rejoins at the back when it ends
+            turns = ready + (len(queue) - 1) * (ready + 1)
+        if any(self._channel_running.get(key, 0) >= limit for key, limit in self._slots(job)):
+            # Free workers don't help a job waiting for its channel
+            return turns + 1
+        return max(0, turns - (self.worker_count - self._running) + 1)
+
+    def _take_job(self):
+        """Pop the next job whose user and channel are free to run"""
+        if self._draining:
+            return None
+        for _ in range(len(self._ready)):
+            user_id = self._ready.popleft()
+            queue = self._user_queues[user_id]
+            job = queue[0]
+            slots = self._slots(job)
+            if any(self._channel_running.get(key, 0) >= limit for key, limit in slots):
+                self._ready.append(user_id)
+                continue
+
+            queue.popleft()
+            self._pending -= 1
+            self._running += 1
+            self._running_jobs.add(job)
+            for key, _ in slots:
+                self._channel_running[key] = self._channel_running.get(key, 0) + 1
+            return job
+        return None
+
+    def _finish_job(self, job):
+        """Release the job's slots and requeue its user if more jobs are waiting"""
+        self._running -= 1
+        self._running_jobs.discard(job)
+        for key, _ in self._slots(job):
+            running = self._channel_running[key] - 1
+            if running:
+                self._channel_running[key] = running
+            else:
+                del self._channel_running[key]
+
+        if self._user_queues[job.user_id]:
+            self._ready.append(job.user_id)
+        else:
+            del self._user_queues[job.user_id]
+
+    async def _worker(self):
+        while True:
+            async with self._condition:
+                job = self._take_job()
+                while job is None:
+                    await self._condition.wait()
+                    job = self._take_job()
+
+            logs.request_id.set(job.request_id)
+            started = time.monotonic()
+            try:
+                await self.handler(job)
+            except Exception as e:
+                logger.error("Error running job for user %s: %s", job.user_id, e)
+            finally:
+                if not isinstance(job, RangeJob):
+                    elapsed = time.monotonic() - started
+                    self.job_seconds = elapsed if not self.job_seconds else 0.9 * self.job_seconds + 0.1 * elapsed
+                async with self._condition:
+                    self._finish_job(job)
+                    self._condition.notify_all()
+
+def command(name, rate_limit='default', subscribers_only=True):
+    """Register a handler in the router's command table.
+
+    Handlers are called as handler(event, user) after the router has applied
+    the rate limit and, for subscribers_only commands, the subscription gate.
+    """
+    def decorator(handler):
+        commands[name] = (handler, rate_limit, subscribers_only)
+        return handler
+    return decorator
+
+def add_router_hook(hook):
+    """Call hook(command, seconds) after every dispatched command"""
+    router_hooks.append(hook)
+
+def record_command_latency(name, seconds):
+    """Router hook recording the latency of each command in the metrics"""
+    histogram = command_histograms.get(name)
+    if histogram is None:
+        histogram = command_histograms[name] = command_seconds.labels(name)
+    histogram.observe(seconds)
+
+def parse_command(text):
+    """Return the command at the start of a message, or TEXT_MESSAGE for plain text"""
+    if not text.startswith('/'):
+        return TEXT_MESSAGE
+    # Drop arguments and a "@botname" suffix
+    return text.split(maxsplit=1)[0].split('@', 1)[0].lower()
+
+async def require_subscription(event, user):
+    """Subscription gate: ask the user to join the channel if they haven't yet"""
+    started = time.perf_counter()
+    if await is_user_subscribed(user.id):
+        SUBSCRIBED_SECONDS.observe(time.perf_counter() - started)
+        return True
+    NOT_SUBSCRIBED_SECONDS.observe(time.perf_counter() - started)
+    
+    await respond(event, SUBSCRIBE_MESSAGE, buttons=SUBSCRIBE_BUTTONS)
+    return False
+
+@client.on(events.NewMessage(incoming=True))
+async def router(event):
+    """Single entry point for messages, timing how long each one takes"""
+    started = time.perf_counter()
+    # Each update runs in its own task, so this only tags this update's logs
+    logs.request_id.set(f'{event.chat_id}:{event.id}')
     try:
-        # Wait a bit before cleanup
-        await asyncio.sleep(5)
-        
-        # Get current session file
-        current_session = f"{session_name}.session"
-        
-        # List all session files
-        for file in os.listdir('.'):
-            if file.endswith('.session') and file != current_session:
-                try:
-                    os.remove(file)
-                    logger.info(f"Removed old session file: {file}")
-                except Exception as e:
-                    logger.error(f"Error removing session file {file}: {e}")
-    except Exception as e:
-        logger.error(f"Error in cleanup_session: {e}")
+        await dispatch(event)
+    finally:
+        update_seconds.observe(time.perf_counter() - started)
 
-@client.on(events.NewMessage(pattern='/start'))
-async def start_handler(event):
-    # Ignore messages from channels and groups
-    if event.is_channel or event.is_group:
-        return
-        
-    # Ignore messages from bots
-    if event.sender_id and event.sender.bot:
+async def dispatch(event):
+    """Parse a message once, gate it once, then run its command handler"""
+    if 'first update' not in startup_timings:
+        mark_startup('first update')
+    
+    # Only handle direct messages with text
+    if not event.is_private or not event.text:
         return
-        
-    # Prevent multiple handlers from responding
-    if event.id in COMMAND_HANDLERS:
+    
+    # Ignore updates we've already handled
+    if recent_updates.seen(event.chat_id, event.id):
         return
-    COMMAND_HANDLERS.add(event.id)
-        
-    user = await event.get_sender()
-    if not await check_cooldown(user.id):
+    
+    name = parse_command(event.text)
+    entry = commands.get(name)
+    if entry is None:
+        return  # Unknown command
+    handler, rate_limit, subscribers_only = entry
+    
+    # Messages missed while offline are paced here instead of by the per-user
+    # rate limit, since users sent them over time rather than in a burst.
+    # A per-user cap still keeps one user's backlog from filling the queue.
+    backlog = catch_up.is_backlog(event)
+    if backlog:
+        if not catch_up.allow(event.sender_id):
+            return
+        await catch_up.admit()
+    
+    # Ignore messages from bots
+    user = await api_limiter.call('users', None, event.get_sender)
+    if user is None or user.bot:
         return
     
-    if not await is_user_subscribed(user.id):
-        buttons = [
-            [Button.url("📢 Join Channel", "https://t.me/morsh_bots")],
-            [Button.inline("✅ Check Subscription", b"check_sub")]
-        ]
-        await event.respond(
-            "🚫 To use this bot, you must subscribe to our channel first:\n"
-            "👉 [Join Morsh Bots](https://t.me/morsh_bots)\n\n"
-            "After joining, click the 'Check Subscription' button below to verify:",
-            buttons=buttons
-        )
+    if rate_limit and not backlog and not await check_cooldown(user.id, rate_limit):
+        return  # Silently ignore if on cooldown
+    
+    if subscribers_only and not await require_subscription(event, user):
         return
     
-    await event.respond(
-        f'👋 Welcome {user.first_name}!\n\n'
-        '🔒 I can help you save and forward content from any Telegram channel.\n\n'
-        '📥 Just send me a Telegram channel post link\n'
-        'and I will fetch its content for you.\n\n'
-        'Use /help to see all available commands.'
-    )
+    started = time.perf_counter()
+    try:
+        await handler(event, user)
+    finally:
+        elapsed = time.perf_counter() - started
+        for hook in router_hooks:
+            hook(name, elapsed)
+
+@command('/start')
+async def start_handler(event, user):
+    await respond(event, WELCOME_MESSAGE.format(first_name=user.first_name))
 
 @client.on(events.CallbackQuery(data=b"check_sub"))
 async def check_subscription(event):
@@ -228,318 +1635,1239 @@ async def check_subscription(event):
     if event.is_channel or event.is_group:
         return
         
-    user = await event.get_sender()
-    if not await check_cooldown(user.id):
+    user = await api_limiter.call('users', None, event.get_sender)
+    if not await check_cooldown(user.id, 'check_sub'):
         return
     
     try:
         # Show checking message
-        await event.answer("Checking subscription status...", alert=False)
+        await api_limiter.call('callback', None, event.answer, "Checking subscription status...", alert=False)
+        
+        # The user may have just joined, so always re-check with Telegram
+        subscription_cache.invalidate(user.id)
         
         if await is_user_subscribed(user.id):
-            await event.answer("✅ You are subscribed! You can now use the bot.", alert=True)
+            await api_limiter.call('callback', None, event.answer, "✅ You are subscribed! You can now use the bot.", alert=True)
             # Update the message to show the welcome message without buttons
-            await event.edit(
-                f'👋 Welcome {user.first_name}!\n\n'
-                '🔒 I can help you save and forward content from any Telegram channel.\n\n'
-                '📥 Just send me a Telegram channel post link\n'
-                'and I will fetch its content for you.\n\n'
-                'Use /help to see all available commands.'
+            await api_limiter.call(
+                'send', event.chat_id, event.edit,
+                WELCOME_MESSAGE.format(first_name=user.first_name)
             )
         else:
-            await event.answer("❌ You are not subscribed to the channel yet! Please join and try again.", alert=True)
+            await api_limiter.call('callback', None, event.answer, "❌ You are not subscribed to the channel yet! Please join and try again.", alert=True)
             # Update the message to show the subscription required message with buttons
-            await event.edit(
-                "🚫 To use this bot, you must subscribe to our channel first:\n"
-                "👉 [Join Morsh Bots](https://t.me/morsh_bots)\n\n"
-                "After joining, click the 'Check Subscription' button below to verify:",
-                buttons=[
-                    [Button.url("📢 Join Channel", "https://t.me/morsh_bots")],
-                    [Button.inline("✅ Check Subscription", b"check_sub")]
-                ]
+            await api_limiter.call(
+                'send', event.chat_id, event.edit,
+                SUBSCRIBE_MESSAGE,
+                buttons=SUBSCRIBE_BUTTONS
             )
     except Exception as e:
-        logger.error(f"Error in check_subscription: {e}")
-        await event.answer("❌ An error occurred. Please try again.", alert=True)
+        subscription_logger.error("Error in check_subscription: %s", e)
+        await api_limiter.call('callback', None, event.answer, "❌ An error occurred. Please try again.", alert=True)
+
+@command('/hello')
+async def hello_handler(event, user):
+    await respond(event, HELLO_MESSAGE.format(first_name=user.first_name))
 
-@client.on(events.NewMessage(pattern='/hello'))
-async def hello_handler(event):
-    user = await event.get_sender()
-    if not await check_cooldown(user.id):
+@command('/help')
+async def help_handler(event, user):
+    await respond(event, HELP_MESSAGE)
+
+@command('/range', rate_limit='/range')
+async def range_handler(event, user):
+    match = RANGE_COMMAND_PATTERN.match(event.text)
+    if not match:
+        await respond(
+            event,
+            "Usage: /range https://t.me/channel/100 250\n"
+            "or: /range https://t.me/channel/100-250"
+        )
         return
     
-    if not await is_user_subscribed(user.id):
-        buttons = [
-            [Button.url("📢 Join Channel", "https://t.me/morsh_bots")],
-            [Button.inline("✅ Check Subscription", b"check_sub")]
-        ]
-        await event.respond(
-            "🚫 To use this bot, you must subscribe to our channel first:\n"
-            "👉 [Join Morsh Bots](https://t.me/morsh_bots)\n\n"
-            "After joining, click the 'Check Subscription' button below to verify:",
-            buttons=buttons
-        )
+    await submit_range(event, user.id, match.group(1), int(match.group(2)), int(match.group(3)))
+
+@command('/search', rate_limit='/search')
+async def search_handler(event, user):
+    if message_archive is None:
+        await respond(event, "Search is not available.")
         return
-    await event.respond(
-        f'👋 Hello {user.first_name}!\n\n'
-        'I\'m your content saving assistant. How can I help you today?'
+    
+    parts = event.text.split(maxsplit=1)
+    if len(parts) < 2 or not archive.match_query(parts[1]):
+        await respond(event, "Usage: /search words to look for")
+        return
+    
+    results = await asyncio.get_running_loop().run_in_executor(
+        archive_executor, message_archive.search, parts[1], ARCHIVE_SEARCH_RESULTS
     )
+    if not results:
+        await respond(event, "No fetched posts match your search.")
+        return
+    
+    lines = [
+        f"• https://t.me/{channel_key}/{message_id}\n{snippet}" if snippet else f"• https://t.me/{channel_key}/{message_id}"
+        for channel_key, message_id, date, snippet in results
+    ]
+    await respond(event, "🔎 Matching posts:\n\n" + "\n\n".join(lines), link_preview=False)
 
-@client.on(events.NewMessage(pattern='/help'))
-async def help_handler(event):
-    user = await event.get_sender()
-    if not await check_cooldown(user.id):
+@command('/cancel', rate_limit=None, subscribers_only=False)
+async def cancel_handler(event, user):
+    job = active_ranges.get(user.id)
+    if job is None:
+        await respond(event, "You have no range in progress.")
         return
     
-    if not await is_user_subscribed(user.id):
-        buttons = [
-            [Button.url("📢 Join Channel", "https://t.me/morsh_bots")],
-            [Button.inline("✅ Check Subscription", b"check_sub")]
-        ]
-        await event.respond(
-            "🚫 To use this bot, you must subscribe to our channel first:\n"
-            "👉 [Join Morsh Bots](https://t.me/morsh_bots)\n\n"
-            "After joining, click the 'Check Subscription' button below to verify:",
-            buttons=buttons
-        )
+    job.cancelled = True
+    await respond(event, "⏹ Stopping your range. Use /resume to continue it later.")
+
+@command('/resume')
+async def resume_handler(event, user):
+    job = paused_ranges.get(user.id)
+    if job is None:
+        await respond(event, "You have no stopped range to resume.")
         return
-    await event.respond(
-        '🔒 Save Restricted Content Bot\n\n'
-        '📥 Save and forward content from any Telegram channel\n'
-        '🔓 Access restricted content easily\n'
-        '📱 Works with private and public channels\n'
-        '⚡ Fast and reliable content delivery\n\n'
-        'Commands:\n'
-        '/start - Start using the bot\n'
-        '/help - Show this help message\n'
-        '/hello - Get a friendly greeting\n\n'
-        'How to use:\n'
-        '1. Send me a Telegram channel post link\n'
-        '2. I will fetch and forward the content to you\n\n'
-        'Note: Some channels may have restrictions'
-    )
+    
+    # submit_range drops the stopped range only once the resumed one is queued,
+    # so it is kept when the user has another range running or the queue is full
+    await submit_range(event, user.id, job.channel_username, job.next_id, job.last_id)
 
-async def get_message_content(channel_username, message_id):
-    """Get message content using multiple methods."""
-    try:
-        # Try to get the channel entity
-        logger.info(f"Attempting to get entity for channel: {channel_username}")
-        channel = await client.get_entity(channel_username)
-        logger.info(f"Successfully got channel entity: {channel}")
-        
-        # Try different methods to get the message
-        try:
-            # Method 1: Direct message fetch
-            logger.info(f"Method 1: Attempting direct message fetch for message ID: {message_id}")
-            message = await client.get_messages(channel, ids=message_id)
-            if message:
-                logger.info("Method 1 succeeded")
-                return message
+def queue_full_message(user_id):
+    """Return the answer to a job the scheduler refused"""
+    if link_scheduler.queued(user_id) >= link_scheduler.max_per_user:
+        return "⚠️ You have too many links waiting. Please wait for them to be sent first."
+    return "⚠️ The bot is currently experiencing high traffic. Please try again in a few minutes."
+
+async def submit_range(event, user_id, channel_username, first_id, last_id):
+    """Validate a requested range of posts and queue it"""
+    if first_id > last_id:
+        first_id, last_id = last_id, first_id
+    if last_id - first_id + 1 > MAX_RANGE_SIZE:
+        await respond(event, f"❌ Ranges are limited to {MAX_RANGE_SIZE} posts.")
+        return
+    
+    if user_id in active_ranges:
+        await respond(event, "You already have a range in progress. Use /cancel to stop it first.")
+        return
+    
+    logger.info("Processing range: channel=%s, posts=%s-%s", channel_username, first_id, last_id)
+    job = RangeJob(user_id, event.chat_id, channel_username, first_id, last_id)
+    position = await link_scheduler.submit(job)
+    if position is None:
+        await respond(event, queue_full_message(user_id))
+        return
+    
+    active_ranges[user_id] = job
+    paused_ranges.pop(user_id, None)
+    if position > 0:
+        await respond(event, f"⏳ Your range is queued at position {position}. It will start shortly.")
+
+def parse_links(text):
+    """Extract post links from text, grouped by channel.
+
+    Returns a dict of channel username -> list of unique message ids, in the
+    order they first appear.
+    """
+    links = {}
+    for match in LINK_PATTERN.finditer(text):
+        message_ids = links.setdefault(match.group(1), [])
+        message_id = int(match.group(2))
+        if message_id not in message_ids and len(message_ids) < MAX_LINKS_PER_MESSAGE:
+            message_ids.append(message_id)
+    return links
+
+# Fetch strategy settings
+FETCH_MIN_SAMPLES = 20  # attempts before a strategy's stats are used to order or skip it
+FETCH_SKIP_RATE = 0.1  # strategies failing more often than this are skipped...
+FETCH_PROBE_EVERY = 50  # ...except for one attempt in this many, in case they recover
+FETCH_STATS_WINDOW = 200  # stats are halved at this many attempts so old results fade
+FETCH_KIND_CACHE_SIZE = 10000  # channels whose kind is remembered
+# Errors that no other strategy can get around
+DEFINITIVE_FETCH_ERRORS = (
+    ChannelPrivateError,
+    ChannelPublicGroupNaError,
+    UsernameInvalidError,
+    UsernameNotOccupiedError
+)
+# Errors from a stale or unusable access hash, which resolving the channel again fixes
+STALE_PEER_ERRORS = (ChannelInvalidError, PeerIdInvalidError)
+
+class FetchEngine:
+    """Runs fetch strategies in the order that has worked best for each kind of channel.
+
+    A strategy is a coroutine function (channel_username, message_ids) that
+    returns the messages found. The first strategy that doesn't raise decides
+    the result, so an empty answer costs a single round-trip. Fallback
+    strategies are never ranked: they only run right after another strategy
+    failed with one of the errors they are meant for.
+    """
+
+    def __init__(self, kind_cache_size=FETCH_KIND_CACHE_SIZE):
+        self.kind_cache_size = kind_cache_size
+        self._strategies = {}  # name -> coroutine function
+        self._fallbacks = {}  # name -> (coroutine function, exception types it handles)
+        self._stats = {}  # (name, kind) -> [attempts, successes, seconds, skipped, ok histogram, error histogram]
+        self._kinds = OrderedDict()  # channel key -> 'public' or 'protected', c/<id> keys are 'private'
+        self.short_circuits = 0
+
+    def strategy(self, name, fallback_for=None):
+        """Register a strategy, tried in registration order until stats say otherwise.
+
+        With fallback_for, a tuple of exception types, the strategy only runs
+        after another one raised one of them.
+        """
+        def register(func):
+            if fallback_for is None:
+                self._strategies[name] = func
             else:
-                logger.warning("Method 1 returned no message")
-        except Exception as e:
-            logger.error(f"Method 1 failed with error: {str(e)}")
-        
-        try:
-            # Method 2: Using InputPeerChannel
-            if hasattr(channel, 'id'):
-                logger.info(f"Method 2: Attempting InputPeerChannel fetch for channel ID: {channel.id}")
-                peer = InputPeerChannel(channel.id, channel.access_hash)
-                message = await client.get_messages(peer, ids=message_id)
-                if message:
-                    logger.info("Method 2 succeeded")
-                    return message
-                else:
-                    logger.warning("Method 2 returned no message")
-        except Exception as e:
-            logger.error(f"Method 2 failed with error: {str(e)}")
-        
+                self._fallbacks[name] = (func, fallback_for)
+            return func
+        return register
+
+    def kind(self, key):
+        """Return the kind of a channel as learned from earlier fetches"""
+        if key.startswith('c/'):
+            return 'private'
+        return self._kinds.get(key, 'public')
+
+    def _learn_kind(self, key, messages):
+        chat = messages[0].chat
+        if chat is None or key.startswith('c/'):
+            return
+        self._kinds[key] = 'protected' if getattr(chat, 'noforwards', False) else 'public'
+        self._kinds.move_to_end(key)
+        while len(self._kinds) > self.kind_cache_size:
+            self._kinds.popitem(last=False)
+
+    def _entry(self, name, kind):
+        stats = self._stats.get((name, kind))
+        if stats is None:
+            stats = self._stats[(name, kind)] = [
+                0, 0, 0.0, 0,
+                fetch_seconds.labels(name, kind, 'ok'),
+                fetch_seconds.labels(name, kind, 'error')
+            ]
+        return stats
+
+    def _record(self, name, kind, ok, seconds):
+        stats = self._entry(name, kind)
+        if ok and stats[0] >= FETCH_MIN_SAMPLES and stats[1] / stats[0] < 1 - FETCH_SKIP_RATE:
+            # A skipped strategy worked again, so give it a clean slate
+            stats[0], stats[1], stats[2] = 0, 0, 0.0
+        if stats[0] >= FETCH_STATS_WINDOW:
+            stats[0] //= 2
+            stats[1] //= 2
+            stats[2] /= 2
+        stats[0] += 1
+        stats[1] += ok
+        stats[2] += seconds
+        (stats[4] if ok else stats[5]).observe(seconds)
+
+    def _order(self, kind):
+        """Return the strategies to try, best success rate first, then lowest latency"""
+        def score(name):
+            attempts, successes, seconds = self._entry(name, kind)[:3]
+            if attempts < FETCH_MIN_SAMPLES:
+                return (0.0, float('inf'))  # no data yet, so after the strategies known to work
+            return (-successes / attempts, seconds / attempts)
+
+        order = []
+        for name in sorted(self._strategies, key=score):
+            stats = self._entry(name, kind)
+            attempts, successes = stats[0], stats[1]
+            if order and attempts >= FETCH_MIN_SAMPLES and successes / attempts < 1 - FETCH_SKIP_RATE:
+                # Unreliable for this kind and something else is left to try
+                stats[3] += 1
+                if stats[3] % FETCH_PROBE_EVERY == 0:
+                    order.insert(0, name)  # try it first now and then in case it has recovered
+                continue
+            order.append(name)
+        return order
+
+    async def fetch(self, channel_username, message_ids):
+        """Return the messages found, raising the last error if every strategy failed"""
+        key = channel_username.lower()
+        kind = self.kind(key)
+        error = None
+        queue = deque((name, self._strategies[name]) for name in self._order(kind))
+        tried = set()
+        while queue:
+            name, func = queue.popleft()
+            tried.add(name)
+            started = time.perf_counter()
+            try:
+                messages = await func(channel_username, message_ids)
+            except FloodWaitError:
+                # api_limiter already waited what it could, and the other
+                # strategies would make the same paused calls
+                self.short_circuits += 1
+                raise
+            except DEFINITIVE_FETCH_ERRORS:
+                self._record(name, kind, False, time.perf_counter() - started)
+                self.short_circuits += 1
+                raise
+            except Exception as e:
+                self._record(name, kind, False, time.perf_counter() - started)
+                fetch_logger.warning("Fetch strategy %s failed for %s: %s", name, channel_username, e)
+                error = e
+                # The fallbacks for this failure go next, ahead of the other ranked strategies
+                queue.extendleft(reversed([
+                    (fallback, fallback_func)
+                    for fallback, (fallback_func, errors) in self._fallbacks.items()
+                    if fallback not in tried and isinstance(e, errors)
+                ]))
+                continue
+
+            self._record(name, kind, True, time.perf_counter() - started)
+            messages = [message for message in messages if message]
+            if messages:
+                self._learn_kind(key, messages)
+            return messages
+        if error is not None:
+            raise error
+        return []
+
+    def stats(self):
+        """Return attempts, success rate and mean latency per strategy and channel kind"""
+        return {
+            f'{name}/{kind}': {
+                'attempts': attempts,
+                'success_rate': successes / attempts,
+                'mean_seconds': seconds / attempts,
+            }
+            for (name, kind), (attempts, successes, seconds, *_) in self._stats.items()
+            if attempts
+        }
+
+fetch_engine = FetchEngine()
+
+@fetch_engine.strategy('cached_peer')
+async def fetch_with_cached_peer(channel_username, message_ids):
+    """Fetch with the cached channel entity, resolving it only on a cache miss"""
+    channel = await resolve_channel(channel_username)
+    return await api_limiter.call(
+        'get_messages', channel_username.lower(),
+        client.get_messages, channel, ids=message_ids
+    )
+
+@fetch_engine.strategy('fresh_peer', fallback_for=STALE_PEER_ERRORS)
+async def fetch_with_fresh_peer(channel_username, message_ids):
+    """Re-resolve the channel first, in case the cached access hash is no longer valid"""
+    # fetch_entity replaces the cached entry once it succeeds, so a failed
+    # lookup leaves the old one in place
+    channel = await fetch_entity(channel_username)
+    return await api_limiter.call(
+        'get_messages', channel_username.lower(),
+        client.get_messages, channel, ids=message_ids
+    )
+
+class MessageCache:
+    """Short-lived cache of fetched posts with single-flight fetching.
+
+    When many users send the same link at once, the first request fetches the
+    post and the others wait for that fetch instead of starting their own.
+    The result, including "not found", is then reused for ttl seconds.
+    """
+
+    def __init__(self, fetch, ttl, max_size):
+        self.fetch = fetch  # coroutine function (channel_username, message_ids) -> messages
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (channel key, message id) -> (message or None, expires at)
+        self._in_flight = {}  # (channel key, message id) -> future of the message or None
+        self.hits = 0
+        self.coalesced = 0
+        self.fetched = 0
+
+    async def get(self, channel_username, message_ids):
+        """Return the messages found, in the order of message_ids"""
+        channel_key = channel_username.lower()
+        now = time.monotonic()
+        found = {}
+        waiting = {}  # message id -> future of a fetch another request started
+        missing = []
+        for message_id in message_ids:
+            key = (channel_key, message_id)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                found[message_id] = entry[0]
+                continue
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                waiting[message_id] = future
+                continue
+            missing.append(message_id)
+
+        if missing:
+            found.update(await self._fetch_missing(channel_username, channel_key, missing))
+        for message_id, future in waiting.items():
+            found[message_id] = await future
+        return [found[message_id] for message_id in message_ids if found.get(message_id)]
+
+    async def _fetch_missing(self, channel_username, channel_key, message_ids):
+        loop = asyncio.get_running_loop()
+        futures = {message_id: loop.create_future() for message_id in message_ids}
+        for message_id, future in futures.items():
+            self._in_flight[(channel_key, message_id)] = future
+
         try:
-            # Method 3: Using GetMessagesRequest
-            if hasattr(channel, 'id'):
-                logger.info(f"Method 3: Attempting GetMessagesRequest for message ID: {message_id}")
-                result = await client(GetMessagesRequest(
-                    id=[message_id]
-                ))
-                if result and result.messages:
-                    logger.info("Method 3 succeeded")
-                    return result.messages[0]
+            messages = await self.fetch(channel_username, message_ids)
+        except BaseException as e:
+            # Requests waiting on this fetch fail the same way
+            for future in futures.values():
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                    future.exception()  # don't warn about it if nobody was waiting
                 else:
-                    logger.warning("Method 3 returned no message")
-        except Exception as e:
-            logger.error(f"Method 3 failed with error: {str(e)}")
-            
-    except Exception as e:
-        logger.error(f"Error in get_message_content: {str(e)}")
-        raise
+                    future.cancel()
+            raise
+        finally:
+            for message_id in message_ids:
+                self._in_flight.pop((channel_key, message_id), None)
 
-@client.on(events.NewMessage)
-async def message_handler(event):
-    # Ignore messages from channels and groups
-    if event.is_channel or event.is_group:
-        return
-        
-    # Ignore messages from bots
-    if event.sender_id and event.sender.bot:
+        self.fetched += len(message_ids)
+        by_id = {message.id: message for message in messages}
+        expires = time.monotonic() + self.ttl
+        result = {}
+        for message_id, future in futures.items():
+            message = by_id.get(message_id)
+            result[message_id] = message
+            future.set_result(message)
+            self._entries[(channel_key, message_id)] = (message, expires)
+            self._entries.move_to_end((channel_key, message_id))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        """Return cache hits, requests that joined an in-flight fetch, and posts fetched"""
+        return {
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'fetched': self.fetched,
+            'size': len(self._entries),
+        }
+
+message_archive = (
+    archive.MessageArchive(ARCHIVE_FILE, ARCHIVE_MAX_MB * 1024 * 1024, ARCHIVE_MAX_AGE)
+    if ARCHIVE_FILE else None
+)
+# One thread, so the archive's connection is used by one thread at a time
+# and reads see the writes queued before them
+archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+compacting_archive = False
+
+def archive_row(channel_key, message):
+    """Return the archive row of a fetched post"""
+    media = message.media
+    media_type = file_name = None
+    if isinstance(media, MessageMediaPhoto):
+        media_type = 'photo'
+    elif isinstance(media, MessageMediaDocument) and isinstance(media.document, Document):
+        media_type = media.document.mime_type
+        for attribute in media.document.attributes:
+            if isinstance(attribute, DocumentAttributeFilename):
+                file_name = attribute.file_name
+    elif media is not None:
+        media_type = type(media).__name__.replace('MessageMedia', '').lower()
+    return (
+        message.peer_id.channel_id,
+        message.id,
+        channel_key,
+        int(message.date.timestamp()) if message.date else None,
+        message.message or '',
+        media_type,
+        file_name,
+        media_size(media) if media is not None else None,
+        int(bool(getattr(message.chat, 'noforwards', False))),
+        bytes(message)
+    )
+
+def archive_messages(channel_key, messages):
+    """Store fetched posts in the archive in its thread, without waiting for the write"""
+    if message_archive is None:
         return
-        
-    # Ignore messages without text
-    if not event.text:
+    try:
+        rows = [
+            archive_row(channel_key, message)
+            for message in messages if isinstance(message.peer_id, PeerChannel)
+        ]
+    except Exception as e:
+        # Archiving is best effort, the posts were fetched either way
+        fetch_logger.warning("Could not archive posts from %s: %s", channel_key, e)
         return
-        
-    # Ignore command messages (they are handled by their own handlers)
-    if event.text.startswith('/'):
+    if rows:
+        future = asyncio.get_running_loop().run_in_executor(archive_executor, message_archive.put, rows)
+        future.add_done_callback(partial(archive_written, channel_key))
+
+def archive_written(channel_key, future):
+    """Log a failed archive write, and compact the archive in a thread after an eviction"""
+    global compacting_archive
+    if future.cancelled():
         return
-        
-    # Prevent multiple handlers from responding
-    if event.id in COMMAND_HANDLERS:
+    if future.exception() is not None:
+        fetch_logger.warning("Could not archive posts from %s: %s", channel_key, future.exception())
         return
-    COMMAND_HANDLERS.add(event.id)
-        
-    user = await event.get_sender()
+    if message_archive.needs_compaction and not compacting_archive:
+        compacting_archive = True
+        asyncio.create_task(compact_archive())
+
+async def compact_archive():
+    global compacting_archive
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, message_archive.compact)
+    except sqlite3.Error as e:
+        logger.warning("Could not compact the archive: %s", e)
+    finally:
+        compacting_archive = False
+
+async def archived_messages(channel_key, message_ids):
+    """Return {message id: message} for the posts the archive can answer"""
+    # Only channels we can address without a network lookup
+    input_chat = cached_channel(channel_key)
+    if message_archive is None or input_chat is None:
+        return {}
+    try:
+        archived = await asyncio.get_running_loop().run_in_executor(
+            archive_executor, message_archive.get, input_chat.channel_id, message_ids
+        )
+    except sqlite3.Error as e:
+        fetch_logger.warning("Could not read archived posts from %s: %s", channel_key, e)
+        return {}
     
-    # Only process messages that are direct messages to the bot
-    if not event.is_private:
-        return
+    messages = {}
+    for message_id, data in archived.items():
+        try:
+            message = BinaryReader(data).tgread_object()
+        except Exception as e:
+            # Written by an older Telethon layer, so fetch it again
+            fetch_logger.debug("Could not read archived post %s/%s: %s", channel_key, message_id, e)
+            continue
+        message._finish_init(client, {}, input_chat)
+        messages[message_id] = message
+    return messages
+
+class KeyedSemaphore:
+    """Lets at most limit holders of the same key run at once, keeping state only for keys in use"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._entries = {}  # key -> [semaphore, holders and waiters]
+        self.waits = 0
+
+    async def acquire(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [asyncio.Semaphore(self.limit), 0]
+        entry[1] += 1
+        if entry[0].locked():
+            self.waits += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._leave(key, entry)
+            raise
+
+    def release(self, key):
+        entry = self._entries[key]
+        entry[0].release()
+        self._leave(key, entry)
+
+    def _leave(self, key, entry):
+        entry[1] -= 1
+        if not entry[1]:
+            del self._entries[key]
+
+    def stats(self):
+        """Return the keys in use and how often a holder had to wait"""
+        return {
+            'keys': len(self._entries),
+            'waits': self.waits,
+        }
+
+channel_fetches = KeyedSemaphore(MAX_FETCHES_PER_CHANNEL)
+
+async def fetch_messages(channel_username, message_ids):
+    """Fetch posts, taking the ones the archive has from disk and archiving the rest"""
+    key = channel_username.lower()
+    found = await archived_messages(key, message_ids)
+    missing = [message_id for message_id in message_ids if message_id not in found]
+    if missing:
+        # Capped per channel here rather than per job, so the deliveries of a
+        # popular post to many chats still run side by side
+        await channel_fetches.acquire(key)
+        try:
+            fetched = await fetch_engine.fetch(channel_username, missing)
+        finally:
+            channel_fetches.release(key)
+        archive_messages(key, fetched)
+        for message in fetched:
+            found[message.id] = message
+    return [found[message_id] for message_id in message_ids if message_id in found]
+
+message_cache = MessageCache(fetch_messages, MESSAGE_CACHE_TTL, MESSAGE_CACHE_SIZE)
+
+async def get_message_content(channel_username, message_ids):
+    """Get the messages with the given ids from a channel.
+
+    Returns the messages that were found, in the order of message_ids.
+    """
+    fetch_logger.info("Fetching messages %s from %s", message_ids, channel_username)
+    return await message_cache.get(channel_username, message_ids)
+
+@command(TEXT_MESSAGE)
+async def message_handler(event, user):
+    # Range links (t.me/channel/100-250) are streamed by a range job,
+    # under the same rate limit as the /range command
+    for match in RANGE_PATTERN.finditer(event.text):
+        if not await check_cooldown(user.id, '/range'):
+            continue
+        await submit_range(event, user.id, match.group(1), int(match.group(2)), int(match.group(3)))
+    
+    links = parse_links(RANGE_PATTERN.sub('', event.text))
+    if not links:
+        return  # Silently ignore non-link messages
+    
+    # A user with links already waiting has been told about the wait before
+    already_waiting = link_scheduler.queued(user.id) > 0
     
-    # Add user to active users set
-    active_users.add(user.id)
+    # Queue one job per channel so each channel costs a single fetch and forward
+    positions = []
+    for channel_username, message_ids in links.items():
+        logger.info("Processing links: channel=%s, message_ids=%s", channel_username, message_ids)
+        for start in range(0, len(message_ids), MAX_IDS_PER_REQUEST):
+            job = LinkJob(user.id, event.chat_id, channel_username, message_ids[start:start + MAX_IDS_PER_REQUEST])
+            position = await link_scheduler.submit(job)
+            if position is None:
+                await respond(event, queue_full_message(user.id))
+                return
+            positions.append(position)
     
-    # Check if we've reached the maximum number of concurrent users
-    if len(active_users) > MAX_CONCURRENT_USERS:
-        await event.respond(
-            "⚠️ The bot is currently experiencing high traffic. Please try again in a few minutes."
+    # Short waits aren't worth an extra message, which would cost a send per link under load
+    position = max(positions)
+    if not already_waiting and link_scheduler.expected_wait(position) >= QUEUE_NOTICE_SECONDS:
+        await respond(event, f"⏳ Your link is queued at position {position}. It will be sent shortly.")
+
+async def deliver_messages(chat_id, messages):
+    """Forward messages from one channel in a single call, resending them if forwarding fails.
+
+    Returns the copies in the user's chat, in the order of messages (None where one failed).
+    """
+    started = time.perf_counter()
+    try:
+        # Try to forward them all in one call first
+        sent = await api_limiter.call(
+            'forward', chat_id,
+            client.forward_messages, chat_id, messages,
+            from_peer=messages[0].input_chat
         )
+        FORWARD_SECONDS.observe(time.perf_counter() - started)
+        delivery_logger.info("Messages forwarded successfully")
+        return sent
+    except Exception as forward_error:
+        delivery_logger.warning("Forward failed, resending content instead: %s", forward_error)
+    
+    started = time.perf_counter()
+    try:
+        return await resend_messages(chat_id, messages)
+    finally:
+        RESEND_SECONDS.observe(time.perf_counter() - started)
+
+async def resend_messages(chat_id, messages):
+    """Resend messages one album or message at a time, returning the copies like deliver_messages"""
+    sent = []
+    for group in group_albums(messages):
+        try:
+            if len(group) > 1:
+                # Resend albums as a single album
+                sent.extend(await resend_album(chat_id, group))
+            else:
+                # If forward fails, resend the entire message
+                sent.append(await resend_message(chat_id, group[0]))
+        except Exception as e:
+            delivery_logger.error("Error sending message: %s", e)
+            sent.extend([None] * len(group))
+            await send_message(
+                chat_id,
+                "❌ Could not send the message. Please try again later."
+            )
+    return sent
+
+async def reply_to_repeats(job):
+    """Answer posts this user was sent lately with a reply to the earlier copy.
+
+    Returns the message ids that still have to be fetched and delivered.
+    """
+    earlier = {}
+    for message_id in job.message_ids:
+        entry = recent_deliveries.get(job.user_id, (job.channel_key, message_id))
+        if entry is not None:
+            earlier[message_id] = entry
+    if not earlier:
+        return job.message_ids
+    
+    copy_id = earlier[next(iter(earlier))][0]
+    try:
+        await send_message(job.chat_id, ALREADY_SENT_MESSAGE, reply_to=copy_id)
+    except RPCError as e:
+        # The earlier copy may have been deleted, so deliver everything again
+        delivery_logger.info("Could not reply to an earlier delivery, sending again: %s", e)
+        for message_id in earlier:
+            recent_deliveries.forget(job.user_id, (job.channel_key, message_id))
+        return job.message_ids
+    
+    recent_deliveries.calls_avoided += max(0, round(sum(cost for _, cost in earlier.values())) - 1)
+    return [message_id for message_id in job.message_ids if message_id not in earlier]
+
+def remember_deliveries(job, messages, copies, calls):
+    """Remember where each delivered post landed, with its share of the delivery's Telegram calls"""
+    delivered = [(message, copy) for message, copy in zip(messages, copies or ()) if copy is not None]
+    if not delivered:
         return
+    # Sending a post again reuses the media of the delivered copy, so a repeat
+    # would cost at most one call per post, whatever the first delivery took
+    cost = min(1, calls / len(delivered))
+    for message, copy in delivered:
+        recent_deliveries.set(job.user_id, (job.channel_key, message.id), (copy.id, cost))
+
+async def resend_message(chat_id, message):
+    """Resend a message, reusing the media of an earlier delivered copy when there is one"""
+    key = delivery_key(message)
+    if key is None:
+        return await send_message(chat_id, message)
     
-    if not await check_cooldown(user.id):
-        return  # Silently ignore if on cooldown
+    cached = delivery_cache.get(key)
+    if cached is None:
+        sent = await send_copy(chat_id, message)
+        delivery_cache.set(key, sent)
+        return sent
     
-    if not await is_user_subscribed(user.id):
-        buttons = [
-            [Button.url("📢 Join Channel", "https://t.me/morsh_bots")],
-            [Button.inline("✅ Check Subscription", b"check_sub")]
-        ]
-        await event.respond(
-            "🚫 To use this bot, you must subscribe to our channel first:\n"
-            "👉 [Join Morsh Bots](https://t.me/morsh_bots)\n\n"
-            "After joining, click the button below to verify:",
-            buttons=buttons
+    try:
+        try:
+            return await send_with_media(chat_id, message, cached.input_media)
+        except FileReferenceExpiredError:
+            # The file reference of our copy expired, fetch the copy again for a fresh one
+            cached = await refresh_delivery(key, cached)
+            return await send_with_media(chat_id, message, cached.input_media)
+    except Exception as e:
+        delivery_logger.warning("Could not reuse delivered media for %s, sending the original: %s", key, e)
+        delivery_cache.invalidate(key)
+        sent = await send_copy(chat_id, message)
+        delivery_cache.set(key, sent)
+        return sent
+
+async def resend_album(chat_id, group):
+    """Resend an album as one album, reusing delivered media for the parts we have cached"""
+    keys = [delivery_key(message) for message in group]
+    cached = [delivery_cache.get(key) if key else None for key in keys]
+    
+    async def send_album(files):
+        return await api_limiter.call(
+            'send', chat_id,
+            client.send_file, chat_id, files,
+            caption=[message.message for message in group]
         )
-        return
     
-    # Regular expression to match Telegram channel post links
-    pattern = r'https?://t\.me/([^/]+)/(\d+)'
-    match = re.search(pattern, event.text)
+    def album_media():
+        return [
+            entry.input_media if entry else message.media
+            for message, entry in zip(group, cached)
+        ]
     
-    if not match:
-        return  # Silently ignore non-link messages
+    try:
+        try:
+            sent = await send_album(album_media())
+        except FileReferenceExpiredError:
+            # Fetch our copies again for fresh file references, like resend_message.
+            # Parts whose copy is gone fall back to the original media.
+            for index, (key, entry) in enumerate(zip(keys, cached)):
+                if entry is None:
+                    continue
+                try:
+                    cached[index] = await refresh_delivery(key, entry)
+                except Exception as e:
+                    delivery_logger.warning("Could not refresh delivered media for %s: %s", key, e)
+                    delivery_cache.invalidate(key)
+                    cached[index] = None
+            sent = await send_album(album_media())
+    except ChatForwardsRestrictedError:
+        # Protected channel, so the parts we don't have yet must be uploaded again
+        delivery_logger.info("Album is protected, transferring %s parts", len(group))
+        media = [
+            entry.input_media if entry else await transfer_engine.upload_media(message.media)
+            for message, entry in zip(group, cached)
+        ]
+        sent = await send_album(media)
     
-    channel_username = match.group(1)
-    message_id = int(match.group(2))
+    for key, copy in zip(keys, sent):
+        if key:
+            delivery_cache.set(key, copy)
+    return sent
+
+async def send_copy(chat_id, message):
+    """Send a copy of a message, re-uploading its media if the channel forbids copying it"""
+    try:
+        return await send_message(chat_id, message)
+    except ChatForwardsRestrictedError:
+        if delivery_key(message) is None:
+            raise
+        delivery_logger.info("Message %s is protected, transferring its media", message.id)
+        media = await transfer_engine.upload_media(message.media)
+        try:
+            return await send_with_media(chat_id, message, media)
+        except FilePartsInvalidError:
+            # Telegram is missing some of the parts, so upload the file once more
+            delivery_logger.warning("Parts of message %s were rejected, transferring again", message.id)
+            media = await transfer_engine.upload_media(message.media)
+            return await send_with_media(chat_id, message, media)
+
+async def send_with_media(chat_id, message, input_media):
+    """Send a message's caption with the given InputMedia instead of its own media"""
+    return await api_limiter.call(
+        'send', chat_id,
+        client.send_file, chat_id, input_media,
+        caption=message.message,
+        formatting_entities=message.entities
+    )
+
+async def refresh_delivery(key, cached):
+    """Fetch a delivered copy again to get fresh file references"""
+    delivery_cache.refreshes += 1
+    copy = await api_limiter.call(
+        'get_messages', cached.chat_id,
+        client.get_messages, cached.chat_id, ids=cached.message_id
+    )
+    if not copy or not delivery_cache.set(key, copy):
+        raise ValueError("delivered copy is no longer available")
+    return delivery_cache.peek(key)
+
+def group_albums(messages):
+    """Split messages into lists, keeping the parts of each album together"""
+    groups = []
+    for message in messages:
+        if message.grouped_id and groups and groups[-1][0].grouped_id == message.grouped_id:
+            groups[-1].append(message)
+        else:
+            groups.append([message])
+    return groups
+
+async def process_link_job(job):
+    """Fetch the linked messages of one channel and send them to the user"""
+    if isinstance(job, RangeJob):
+        await process_range_job(job)
+        return
     
-    logger.info(f"Processing link: channel={channel_username}, message_id={message_id}")
+    # In sharded mode the worker that owns the channel does the work.
+    # Ranges stay here so /cancel and /resume can reach them.
+    if shard_dispatcher is not None:
+        data = job.to_dict()
+        channel = cached_channel(job.channel_key) if job.channel_key.startswith('c/') else None
+        if channel is not None:
+            # Workers don't receive updates, so send along the hash from our index
+            data['access_hash'] = channel.access_hash
+        result = await shard_dispatcher.run(data)
+        if not result['ok']:
+            logger.error("Shard %s failed a job: %s", result['shard'], result['error'])
+            await send_message(
+                job.chat_id,
+                "Sorry, I couldn't fetch the message. Please try again later."
+            )
+        return
     
+    calls = [0]
+    outbound_calls.set(calls)
     try:
-        # Get the message using our enhanced method
-        message = await get_message_content(channel_username, message_id)
+        message_ids = await reply_to_repeats(job)
+        if not message_ids:
+            return
         
-        if message:
-            logger.info("Successfully retrieved message, attempting to send content")
-            try:
-                # Try to forward first
-                await client.forward_messages(
-                    event.chat_id,
-                    message
+        # Get the messages using our enhanced method
+        messages = await get_message_content(job.channel_username, message_ids)
+        
+        if messages:
+            logger.info("Successfully retrieved %s messages, attempting to send content", len(messages))
+            # A repeat would usually find the posts in the message cache or the
+            # archive, so only the delivery counts as what it saves
+            calls[0] = 0
+            copies = await deliver_messages(job.chat_id, messages)
+            remember_deliveries(job, messages, copies, calls[0])
+            
+            found = {message.id for message in messages}
+            missing = [message_id for message_id in message_ids if message_id not in found]
+            if missing:
+                await send_message(
+                    job.chat_id,
+                    f"Some messages were not found: {', '.join(map(str, missing))}"
                 )
-                logger.info("Message forwarded successfully")
-            except Exception as forward_error:
-                logger.warning(f"Forward failed, resending content instead: {str(forward_error)}")
-                try:
-                    # If forward fails, resend the entire message
-                    await client.send_message(
-                        event.chat_id,
-                        message
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending message: {str(e)}")
-                    await event.respond(
-                        "❌ Could not send the message. Please try again later."
-                    )
         else:
             logger.warning("No message content found")
-            await event.respond("Message not found.")
+            await send_message(job.chat_id, "Message not found.")
             
+    except DEFINITIVE_FETCH_ERRORS as e:
+        logger.info("Cannot access %s: %s", job.channel_username, e)
+        await send_message(
+            job.chat_id,
+            "❌ I can't access this channel. It may be private or no longer exist."
+        )
     except Exception as e:
-        logger.error(f"Error fetching message: {str(e)}")
-        await event.respond(
+        logger.error("Error fetching message: %s", e)
+        await send_message(
+            job.chat_id,
             "Sorry, I couldn't fetch the message. Please try again later."
         )
 
+async def process_range_job(job):
+    """Stream a range of posts to the user one page at a time"""
+    try:
+        channel = await resolve_channel(job.channel_username)
+        while job.next_id <= job.last_id and not job.cancelled:
+            page = await api_limiter.call(
+                'get_messages', job.channel_key,
+                client.get_messages, channel,
+                min_id=job.next_id - 1, max_id=job.last_id + 1,
+                limit=RANGE_PAGE_SIZE, reverse=True
+            )
+            if not page:
+                break
+            
+            # Leave an album that may continue on the next page for the next fetch
+            if len(page) == RANGE_PAGE_SIZE and page[-1].grouped_id:
+                trailing = len(group_albums(page)[-1])
+                if trailing < len(page):
+                    page = page[:-trailing]
+            
+            # Service messages (joins, pins, ...) can't be delivered
+            messages = [message for message in page if not message.action]
+            archive_messages(job.channel_key, messages)
+            if messages:
+                await deliver_messages(job.chat_id, messages)
+            job.next_id = page[-1].id + 1
+        
+        if job.cancelled:
+            paused_ranges[job.user_id] = job
+            await send_message(job.chat_id, f"⏹ Range stopped before post {job.next_id}. Use /resume to continue.")
+        else:
+            await send_message(job.chat_id, f"✅ Finished sending posts {job.first_id}-{job.last_id}.")
+    
+    except Exception as e:
+        fetch_logger.error("Error streaming range: %s", e)
+        paused_ranges[job.user_id] = job
+        await send_message(
+            job.chat_id,
+            f"Sorry, the range stopped before post {job.next_id}. Use /resume to try again."
+        )
+    finally:
+        if active_ranges.get(job.user_id) is job:
+            del active_ranges[job.user_id]
+
+add_router_hook(record_command_latency)
+
+shard_dispatcher = None  # ShardDispatcher when SHARD_WORKERS is set
+
+def start_sharding():
+    """Start the shard worker processes unless they are already running"""
+    global shard_dispatcher
+    if shard_dispatcher is not None or not SHARD_WORKERS:
+        return
+    from sharding import ShardDispatcher
+    shard_dispatcher = ShardDispatcher(SHARD_WORKERS)
+    shard_dispatcher.start()
+
+link_scheduler = LinkScheduler(
+    process_link_job,
+    WORKER_COUNT,
+    MAX_QUEUED_JOBS,
+    MAX_JOBS_PER_USER,
+    MAX_RANGES_PER_CHANNEL,
+    MAX_RUNNING_RANGES
+)
+
+# Component counters, read when the metrics are rendered
+for metric_name, component in (
+    ('bot_link_queue', link_scheduler),
+    ('bot_api_limiter', api_limiter),
+    ('bot_dedup_window', recent_updates),
+    ('bot_catch_up', catch_up),
+    ('bot_message_cache', message_cache),
+    ('bot_channel_fetches', channel_fetches),
+    ('bot_subscription_cache', subscription_cache),
+    ('bot_delivery_cache', delivery_cache),
+    ('bot_recent_deliveries', recent_deliveries),
+    ('bot_transfers', transfer_engine),
+):
+    metrics.registry.gauge(metric_name, f'{type(component).__name__} counters', component.stats, label='stat')
+if message_archive is not None:
+    metrics.registry.gauge('bot_archive', 'MessageArchive counters', message_archive.stats, label='stat')
+metrics.registry.gauge('bot_active_ranges', 'Ranges queued or running', lambda: len(active_ranges))
+metrics.registry.gauge(
+    'bot_log_records_sampled_out', 'INFO records dropped by LOG_SAMPLE_RATE',
+    lambda: logs.sampler.dropped if logs.sampler else 0
+)
+
+metrics_started = False
+metrics_server = None  # asyncio server behind METRICS_PORT
+
+async def start_metrics():
+    """Start the metrics endpoint and file writer if they are configured"""
+    global metrics_started, metrics_server
+    if metrics_started:
+        return
+    metrics_started = True
+    if METRICS_PORT:
+        try:
+            metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error("Could not serve metrics on port %s: %s", METRICS_PORT, e)
+    if METRICS_FILE:
+        lifecycle.supervise('metrics file', lambda: metrics.dump_periodically(METRICS_FILE, METRICS_DUMP_INTERVAL))
+
+# Lifecycle settings
+RECONNECT_MIN_DELAY = 1  # seconds before the first reconnect or task restart
+RECONNECT_MAX_DELAY = int(os.getenv('RECONNECT_MAX_DELAY', 300))  # longest delay between attempts
+RECONNECT_STABLE_AFTER = 60  # seconds of uptime after which the delay starts over
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', 25))  # seconds running jobs get on shutdown; Heroku kills after 30
+PENDING_JOBS_FILE = os.getenv('PENDING_JOBS_FILE', 'pending_jobs.json')  # unfinished jobs, resumed on the next start
+
+def backoff_delay(attempt):
+    """Exponential delay for the given attempt, with jitter so restarts don't line up"""
+    delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** min(attempt, 30))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class Lifecycle:
+    """Supervises the background tasks and turns a stop signal into a clean shutdown"""
+
+    def __init__(self):
+        self._tasks = {}  # name -> supervising task
+        self.stopping = asyncio.Event()
+        self.reconnects = 0
+        self.task_restarts = 0
+        self.jobs_resumed = 0
+
+    def supervise(self, name, func):
+        """Run func() in the background, restarting it with a backoff whenever it crashes"""
+        task = self._tasks.get(name)
+        if task is None or task.done():
+            self._tasks[name] = asyncio.create_task(self._run(name, func))
+
+    async def _run(self, name, func):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                await func()
+                return
+            except Exception as e:
+                logger.error("Background task %s crashed: %s", name, e, exc_info=True)
+            if time.monotonic() - started >= RECONNECT_STABLE_AFTER:
+                attempt = 0
+            self.task_restarts += 1
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def install_signal_handlers(self):
+        """Shut down cleanly on SIGTERM (sent by Heroku and systemd) and SIGINT"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig.name)
+            except (NotImplementedError, RuntimeError):
+                pass  # not supported on Windows, KeyboardInterrupt still works there
+
+    def request_stop(self, reason):
+        if not self.stopping.is_set():
+            logger.info("Received %s, shutting down", reason)
+            self.stopping.set()
+
+    async def wait(self, seconds):
+        """Sleep for seconds, returning early when a shutdown is requested"""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_until_disconnected(self):
+        """Wait until the client disconnects or a shutdown is requested"""
+        disconnected = asyncio.ensure_future(client.disconnected)
+        stopping = asyncio.ensure_future(self.stopping.wait())
+        done, waiting = await asyncio.wait((disconnected, stopping), return_when=asyncio.FIRST_COMPLETED)
+        for future in waiting:
+            future.cancel()
+        if disconnected in done:
+            disconnected.result()  # raises the error that closed the connection, if any
+
+    async def shutdown(self):
+        """Drain the running jobs, save the unfinished ones and close everything"""
+        started = time.monotonic()
+        unfinished = await link_scheduler.drain(DRAIN_TIMEOUT)
+        save_pending_jobs(unfinished)
+
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        if metrics_server is not None:
+            metrics_server.close()
+        if shard_dispatcher is not None:
+            await asyncio.get_running_loop().run_in_executor(None, shard_dispatcher.stop)
+        if client.is_connected():
+            # Disconnecting closes the session, which writes it to disk
+            await client.disconnect()
+        logger.info(
+            "Shut down in %.1fs, %s unfinished jobs saved",
+            time.monotonic() - started, len(unfinished)
+        )
+
+    def stats(self):
+        """Return reconnects, background task restarts and jobs resumed from the last run"""
+        return {
+            'reconnects': self.reconnects,
+            'task_restarts': self.task_restarts,
+            'jobs_resumed': self.jobs_resumed,
+        }
+
+lifecycle = Lifecycle()
+metrics.registry.gauge('bot_lifecycle', 'Lifecycle counters', lifecycle.stats, label='stat')
+
+def save_pending_jobs(jobs):
+    """Write unfinished jobs to PENDING_JOBS_FILE so the next start can resume them"""
+    if not jobs:
+        return
+    temporary = f'{PENDING_JOBS_FILE}.tmp'
+    try:
+        with open(temporary, 'w') as file:
+            json.dump([job.to_dict() for job in jobs], file)
+        os.replace(temporary, PENDING_JOBS_FILE)
+    except OSError as e:
+        logger.error("Could not save %s unfinished jobs: %s", len(jobs), e)
+
+async def resume_pending_jobs():
+    """Queue the jobs saved by the previous shutdown, then forget them"""
+    try:
+        with open(PENDING_JOBS_FILE) as file:
+            saved = json.load(file)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.error("Could not read %s: %s", PENDING_JOBS_FILE, e)
+        return
+    os.remove(PENDING_JOBS_FILE)
+
+    for data in saved:
+        job = job_from_dict(data)
+        if await link_scheduler.submit(job) is None:
+            logger.warning("Queue is full, dropping a saved job of user %s", job.user_id)
+            continue
+        if isinstance(job, RangeJob):
+            active_ranges[job.user_id] = job
+        lifecycle.jobs_resumed += 1
+    logger.info("Resumed %s jobs from the last run", lifecycle.jobs_resumed)
+
+startup_timings = {}  # stage -> seconds since STARTUP_STARTED, first run only
+
+def mark_startup(stage):
+    """Record when a startup stage finished and log the breakdown after the first update"""
+    if stage in startup_timings:
+        return
+    startup_timings[stage] = time.perf_counter() - STARTUP_STARTED
+    if stage == 'first update':
+        logger.info("Startup timings: " + ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in startup_timings.items()
+        ))
+
+async def server_clock_offset():
+    """Return how far Telegram's clock is ahead of ours, in seconds.
+
+    Message dates come from Telegram's clock, so comparing them with our own
+    would misplace messages by however much the local clock is off.
+    """
+    try:
+        sent = time.time()
+        state = await api_limiter.call('auth', None, client, GetStateRequest())
+        received = time.time()
+    except (RPCError, ConnectionError) as e:
+        logger.warning("Couldn't read the server time, using the local clock: %s", e)
+        return 0.0
+    # The server time is cut to whole seconds, so take the middle of that second
+    return state.date.timestamp() + 0.5 - (sent + received) / 2
+
+async def connect_client():
+    """Connect and sign in only if the session isn't authorized yet"""
+    started = time.monotonic()
+    # Anything dated before this was sent while we were offline
+    connected_at = time.time()
+    await client.connect()
+    mark_startup('connect')
+    if not await client.is_user_authorized():
+        logger.info("Session is not authorized, signing in with the bot token")
+        await api_limiter.call('auth', None, client.sign_in, bot_token=BOT_TOKEN)
+    mark_startup('auth')
+    catch_up.reset(connected_at + await server_clock_offset())
+    logger.info("Connected in %.2fs", time.monotonic() - started)
+
 async def main():
-    """Start the bot with automatic reconnection."""
+    """Start the bot, reconnecting with a backoff until it is asked to stop."""
     logger.info("Starting the bot...")
-    while True:
+    lifecycle.install_signal_handlers()
+    lifecycle.supervise('rate limit cleanup', cleanup_inactive_users)
+    resumed = False
+    attempt = 0
+    while not lifecycle.stopping.is_set():
+        connected_at = None
         try:
-            # Start the cleanup task
-            asyncio.create_task(cleanup_inactive_users())
-            
-            # Start the bot with retry mechanism
-            max_retries = 3
-            retry_delay = 5
-            
-            for attempt in range(max_retries):
-                try:
-                    logger.info("Attempting to start the bot...")
-                    await client.start(bot_token=BOT_TOKEN)
-                    logger.info("Bot started successfully!")
-                    print("Bot is running...")
-                    await client.run_until_disconnected()
-                    break
-                except sqlite3.OperationalError as e:
-                    if "database is locked" in str(e):
-                        if attempt < max_retries - 1:
-                            logger.warning(f"Database locked, retrying in {retry_delay} seconds...")
-                            await asyncio.sleep(retry_delay)
-                            retry_delay *= 2  # Exponential backoff
-                        else:
-                            logger.error("Max retries reached, could not start bot")
-                            raise
-                    else:
-                        raise
+            await connect_client()
+            connected_at = time.monotonic()
+            logger.info("Bot started successfully!")
+            lifecycle.supervise('member sync', sync_channel_members)
+            if CATCH_UP:
+                lifecycle.supervise('update state', save_update_state)
+            await start_metrics()
+            start_sharding()
+            link_scheduler.start()
+            if not resumed:
+                resumed = True
+                await resume_pending_jobs()
+            print("Bot is running...")
+            await lifecycle.run_until_disconnected()
         except (ConnectionError, ServerError) as e:
-            logger.error(f"Connection error: {e}")
-            logger.info("Attempting to reconnect in 30 seconds...")
-            await asyncio.sleep(30)
-            continue
+            logger.error("Connection error: %s", e)
         except Exception as e:
-            logger.error(f"Error in main: {e}")
-            logger.info("Attempting to reconnect in 30 seconds...")
-            await asyncio.sleep(30)
-            continue
-        finally:
-            # Ensure the client is disconnected
-            if client.is_connected():
-                client.disconnect()
-            # Clean up all session files
-            cleanup_all_sessions()
+            logger.error("Error in main: %s", e)
+        if lifecycle.stopping.is_set():
+            break
+
+        # Telethon has already retried the connection itself, so back off before a fresh one.
+        # The session is kept, so reconnecting doesn't sign in again.
+        if connected_at is not None and time.monotonic() - connected_at >= RECONNECT_STABLE_AFTER:
+            attempt = 0
+        delay = backoff_delay(attempt)
+        attempt += 1
+        lifecycle.reconnects += 1
+        logger.info("Reconnecting in %.1fs (attempt %s)", delay, attempt)
+        if client.is_connected():
+            await client.disconnect()
+        await lifecycle.wait(delay)
+    await lifecycle.shutdown()
+
+def run(coroutine):
+    """Run a coroutine on uvloop when it's installed, else on the default asyncio loop"""
+    if USE_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            if hasattr(uvloop, 'run'):
+                return uvloop.run(coroutine)
+            # uvloop before 0.18 has no run(), only the loop policy
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coroutine)
+
+mark_startup('import')
 
 if __name__ == '__main__':
     try:
-        # Create new event loop
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # Run the main function
-        loop.run_until_complete(main())
+        run(main())
     except KeyboardInterrupt:
         print("\nBot stopped by user")
-        # Clean up sessions on keyboard interrupt
-        cleanup_all_sessions()
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
-        # Clean up sessions on error
-        cleanup_all_sessions()
-    finally:
-        # Close the event loop
-        loop.close()
+        logger.error("Fatal error: %s", e)
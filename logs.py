@@ -0,0 +1,136 @@
+"""Logging setup for bot.py.
+
+Records are handed to a background thread through a queue, so a slow stdout
+or disk never blocks the event loop. They are only formatted on that thread,
+as plain text or as one JSON object per line, and carry the id of the update
+or job they belong to. Repetitive INFO messages can be sampled.
+
+Configured from the environment:
+
+    LOG_LEVEL=INFO                          # default level
+    LOG_LEVELS=bot.fetch=DEBUG,telethon=WARNING
+    LOG_FORMAT=json                         # or text
+    LOG_ASYNC=1                             # 0 writes from the calling thread
+    LOG_SAMPLE_RATE=10                      # keep 1 in 10 of each INFO message
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+SAMPLE_TEMPLATES = 1000  # message templates tracked for sampling before the counts are reset
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+class RequestIdFilter(logging.Filter):
+    """Attach the current request id to every record"""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keep the first and then one in `rate` of each INFO-or-lower message template.
+
+    Messages must use lazy % formatting for this to work, since records are
+    grouped by their unformatted template.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._counts = {}  # (logger name, template) -> records seen
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+
+        key = (record.name, record.msg)
+        count = self._counts.get(key, 0)
+        if len(self._counts) >= SAMPLE_TEMPLATES and count == 0:
+            self._counts.clear()
+        self._counts[key] = count + 1
+        if count % self.rate:
+            self.dropped += 1
+            return False
+        return True
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue records without formatting them, the listener thread does that"""
+
+    def prepare(self, record):
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None) is not None:
+            entry['request_id'] = record.request_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """The usual text format, with the request id appended when there is one"""
+
+    def format(self, record):
+        line = super().format(record)
+        if getattr(record, 'request_id', None) is not None:
+            line += f' [{record.request_id}]'
+        return line
+
+def parse_levels(value):
+    """Parse 'name=LEVEL,name=LEVEL' into a dict"""
+    levels = {}
+    for item in value.split(','):
+        name, _, level = item.strip().partition('=')
+        if name and level:
+            levels[name] = level.strip().upper()
+    return levels
+
+listener = None  # QueueListener writing records in the background, if LOG_ASYNC is on
+sampler = None  # SamplingFilter, if LOG_SAMPLE_RATE is above 1
+
+def configure():
+    """Set up the root logger from the environment"""
+    global listener, sampler
+    level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    levels = parse_levels(os.getenv('LOG_LEVELS', ''))
+    use_json = os.getenv('LOG_FORMAT', 'text') == 'json'
+    use_queue = os.getenv('LOG_ASYNC', '1') == '1'
+    sample_rate = int(os.getenv('LOG_SAMPLE_RATE', 1))
+
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if use_json else TextFormatter(TEXT_FORMAT))
+
+    if use_queue:
+        handler = DeferredQueueHandler(queue.SimpleQueue())
+        listener = QueueListener(handler.queue, output)
+        listener.start()
+        atexit.register(listener.stop)  # flush what is still queued
+    else:
+        handler = output
+
+    # Filters run on the calling thread, so they stay cheap
+    handler.addFilter(RequestIdFilter())
+    if sample_rate > 1:
+        sampler = SamplingFilter(sample_rate)
+        handler.addFilter(sampler)
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    for name, name_level in levels.items():
+        logging.getLogger(name).setLevel(name_level)
@@ -0,0 +1,217 @@
+"""Counters, gauges and latency histograms for bot.py.
+
+Metrics are kept in plain Python objects whose buckets and label children are
+allocated up front, so recording a value is a few integer and float updates.
+They are rendered in the Prometheus text format, either over a small local
+HTTP endpoint or as a file written every few seconds:
+
+    METRICS_PORT=9100 python bot.py       # curl http://127.0.0.1:9100/metrics
+    METRICS_FILE=metrics.prom python bot.py
+"""
+import asyncio
+import logging
+import os
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cache hit up to a large media transfer
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    """Monotonic counter"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Family:
+    """A metric with optional labels; children are created once per label value set"""
+
+    def __init__(self, kind, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._children = {}  # label values -> Counter or Histogram
+        if not self.label_names:
+            self._unlabelled = self._new_child()
+
+    def _new_child(self):
+        return Histogram(self.buckets) if self.kind == 'histogram' else Counter()
+
+    def labels(self, *values):
+        """Return the child for these label values, creating it on first use.
+
+        Hot paths should look children up once and keep them.
+        """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    # Shortcuts for metrics without labels
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def _samples(self):
+        if not self.label_names:
+            yield (), self._unlabelled
+        else:
+            yield from self._children.items()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in self._samples():
+            labels = _format_labels(self.label_names, values)
+            if self.kind == 'counter':
+                lines.append(f'{self.name}{labels} {_format_value(child.value)}')
+                continue
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                bucket_labels = _format_labels(
+                    self.label_names + ('le',),
+                    values + (_format_value(bound),)
+                )
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+            lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+class Gauge:
+    """A value read from a callback when the metrics are rendered.
+
+    With a label, the callback returns a dict of label value -> number.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func, label=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.label = label
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.warning("Could not read gauge %s: %s", self.name, e)
+            return lines
+        if self.label:
+            for key, number in value.items():
+                lines.append(f'{self.name}{{{self.label}="{key}"}} {_format_value(number)}')
+        else:
+            lines.append(f'{self.name} {_format_value(value)}')
+        return lines
+
+class Registry:
+    """Holds every metric and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Family('counter', name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Family('histogram', name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, func, label=None):
+        return self._add(Gauge(name, help_text, func, label))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Drain the headers, we only care about the path
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b'/metrics':
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning("Error serving metrics: %s", e)
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    """Serve /metrics over HTTP on host:port"""
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
+
+async def dump_periodically(path, interval):
+    """Write the metrics to path every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            temporary = f'{path}.tmp'
+            with open(temporary, 'w') as file:
+                file.write(registry.render())
+            os.replace(temporary, path)  # readers never see a half-written file
+        except OSError as e:
+            logger.warning("Could not write metrics to %s: %s", path, e)
@@ -0,0 +1,362 @@
+"""Sharded deployment for bot.py.
+
+A dispatcher (the normal bot process) receives updates and hands fetch/forward
+jobs to N worker processes over multiprocessing queues. Each worker holds its
+own Telegram session. Jobs are routed by consistent hashing on the channel, so
+a channel always lands on the same worker and its entity and media caches stay
+warm there. Workers that die are started again, and the jobs they had fail.
+
+Set SHARD_WORKERS in the environment to enable it. To try it locally without
+Telegram, run the dispatcher against stub workers:
+
+    python sharding.py --selftest
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+VIRTUAL_NODES = 64  # points per worker on the hash ring
+SHUTDOWN_TIMEOUT = 10  # seconds to wait for workers to exit
+JOB_TIMEOUT = int(os.getenv('SHARD_JOB_TIMEOUT', 900))  # seconds before a job sent to a worker is given up on
+WATCH_INTERVAL = 1  # seconds between checks that the workers are alive
+RESTART_MIN_DELAY = 1  # seconds before a dead worker is started again...
+RESTART_MAX_DELAY = 60  # ...doubling up to this while it keeps dying soon after starting
+RESTART_STABLE_AFTER = 60  # seconds a worker must run before its restart delay starts over
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+class HashRing:
+    """Consistent hash ring mapping channel keys to worker ids"""
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        points = sorted(
+            (_hash(f'{node}:{index}'), node)
+            for node in nodes
+            for index in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        """Return the worker that owns a key"""
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+class ShardDispatcher:
+    """Starts worker processes, routes jobs to them by channel and restarts the ones that die"""
+
+    def __init__(self, worker_count, client_kind='telegram'):
+        self._context = multiprocessing.get_context('spawn')
+        self.client_kind = client_kind
+        self.ring = HashRing(range(worker_count))
+        self.routed = [0] * worker_count  # jobs sent to each worker
+        self.restarts = 0
+        self.timeouts = 0
+        # Each worker gets its own job queue and result pipe, so a worker that is
+        # killed while holding one of their locks can't block the others
+        self._job_queues = [self._context.Queue() for _ in range(worker_count)]
+        self._result_pipes = [None] * worker_count  # read end of each worker's result pipe
+        self._processes = [None] * worker_count
+        self._started_at = [0.0] * worker_count
+        self._quick_deaths = [0] * worker_count  # deaths in a row soon after starting
+        self._restarting = set()  # shard ids waiting to be started again
+        self._pending = {}  # job id -> (future waiting for the worker's result, shard id)
+        self._job_ids = itertools.count(1)
+        self._stopping = False
+        self._reader = None
+        self._restart_tasks = set()
+
+    def _start_process(self, shard_id):
+        results, worker_results = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=worker_main,
+            args=(shard_id, self._job_queues[shard_id], worker_results, self.client_kind),
+            name=f'shard-{shard_id}',
+            daemon=True
+        )
+        # A spawned process first runs the parent's __main__ module again, which in
+        # production is bot.py, with SHARD_ID unset: that copy would open the
+        # dispatcher's session and caches. Start it from this module instead, so
+        # bot is only imported by worker_main.
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = sys.modules[__name__]
+        try:
+            process.start()
+        finally:
+            sys.modules['__main__'] = main
+        # Only the worker keeps the write end, so the pipe closes when it exits
+        worker_results.close()
+        self._result_pipes[shard_id] = results
+        self._processes[shard_id] = process
+        self._started_at[shard_id] = time.monotonic()
+
+    def start(self):
+        """Start the worker processes and the task collecting their results"""
+        for shard_id in range(len(self._processes)):
+            self._start_process(shard_id)
+        self._reader = asyncio.create_task(self._read_results())
+        logger.info("Started %s shard workers", len(self._processes))
+
+    async def run(self, job):
+        """Send a job (a dict from LinkJob.to_dict) to its worker and wait for the result.
+
+        If the worker dies or the job takes longer than JOB_TIMEOUT, the result
+        has ok set to False.
+        """
+        job = dict(job, id=next(self._job_ids))
+        shard_id = self.ring.node_for(job['channel_key'])
+        future = asyncio.get_running_loop().create_future()
+        self._pending[job['id']] = (future, shard_id)
+        self._job_queues[shard_id].put(job)
+        self.routed[shard_id] += 1
+        try:
+            return await asyncio.wait_for(future, JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return {'id': job['id'], 'shard': shard_id, 'ok': False, 'error': f'no result after {JOB_TIMEOUT}s'}
+        finally:
+            self._pending.pop(job['id'], None)
+
+    def stop(self):
+        """Ask the workers to finish their jobs and exit"""
+        self._stopping = True
+        for jobs in self._job_queues:
+            jobs.put(None)
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for process in self._processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+
+    def stats(self):
+        """Return the jobs routed to each worker, the jobs still running and worker health"""
+        return {
+            'routed': list(self.routed),
+            'pending': len(self._pending),
+            'alive': sum(1 for process in self._processes if process.is_alive()),
+            'restarts': self.restarts,
+            'timeouts': self.timeouts,
+        }
+
+    async def _read_results(self):
+        """Collect results from the workers and restart the ones that exit"""
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            results = {}  # result pipe -> shard id
+            sentinels = {}  # process sentinel -> shard id
+            for shard_id, process in enumerate(self._processes):
+                if shard_id not in self._restarting:
+                    results[self._result_pipes[shard_id]] = shard_id
+                    sentinels[process.sentinel] = shard_id
+            ready = await loop.run_in_executor(
+                None, multiprocessing.connection.wait, [*results, *sentinels], WATCH_INTERVAL
+            )
+
+            # Take the results first, a worker may have sent some just before exiting
+            for pipe in ready:
+                if pipe in results:
+                    self._take_results(pipe)
+            for sentinel in ready:
+                if sentinel in sentinels and not self._stopping:
+                    shard_id = sentinels[sentinel]
+                    # Reap it, so its exit code is known
+                    await loop.run_in_executor(None, self._processes[shard_id].join, WATCH_INTERVAL)
+                    self._worker_died(shard_id)
+
+    def _take_results(self, pipe):
+        try:
+            while pipe.poll():
+                result = pipe.recv()
+                entry = self._pending.pop(result['id'], None)
+                if entry is not None and not entry[0].done():
+                    entry[0].set_result(result)
+        except EOFError:
+            pass  # the worker exited, its sentinel says so too
+
+    def _worker_died(self, shard_id):
+        process = self._processes[shard_id]
+        logger.error("Shard worker %s exited with code %s", shard_id, process.exitcode)
+
+        # The jobs it had taken are lost, and the queued ones would only run
+        # after their callers were told they failed, so both are given up on
+        error = f'shard worker exited with code {process.exitcode}'
+        for job_id, (future, job_shard) in list(self._pending.items()):
+            if job_shard == shard_id:
+                del self._pending[job_id]
+                if not future.done():
+                    future.set_result({'id': job_id, 'shard': shard_id, 'ok': False, 'error': error})
+        self._job_queues[shard_id].cancel_join_thread()
+        self._result_pipes[shard_id].close()
+        # Jobs routed here from now on wait in a fresh queue for the new worker
+        self._job_queues[shard_id] = self._context.Queue()
+
+        if time.monotonic() - self._started_at[shard_id] < RESTART_STABLE_AFTER:
+            self._quick_deaths[shard_id] += 1
+        else:
+            self._quick_deaths[shard_id] = 0
+        delay = min(RESTART_MAX_DELAY, RESTART_MIN_DELAY * 2 ** max(0, self._quick_deaths[shard_id] - 1))
+        self._restarting.add(shard_id)
+        task = asyncio.create_task(self._restart_worker(shard_id, delay))
+        self._restart_tasks.add(task)
+        task.add_done_callback(self._restart_tasks.discard)
+
+    async def _restart_worker(self, shard_id, delay):
+        await asyncio.sleep(delay)
+        if self._stopping:
+            return
+        self._start_process(shard_id)
+        self._restarting.discard(shard_id)
+        self.restarts += 1
+        logger.info("Restarted shard worker %s", shard_id)
+
+def worker_main(shard_id, jobs, results, client_kind):
+    """Entry point of a worker process"""
+    # The dispatcher stops workers once it has drained its jobs, so a SIGTERM
+    # or Ctrl+C sent to the whole process group must not cut their jobs short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # bot.py reads these at import time to pick a per-shard session and cache
+    os.environ['SHARD_ID'] = str(shard_id)
+    import bot
+
+    if client_kind == 'stub':
+        bot.client = StubClient()
+    bot.run(_worker_loop(bot, shard_id, jobs, results, client_kind))
+
+async def _worker_loop(bot, shard_id, jobs, results, client_kind):
+    if client_kind == 'telegram':
+        # Workers log in as the dispatcher's bot, in sessions of their own. Only
+        # that bot may message its users, and access hashes are valid for it only.
+        await bot.api_limiter.call('auth', None, bot.client.start, bot_token=bot.BOT_TOKEN)
+        logger.info("Shard worker %s connected", shard_id)
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(bot.SHARD_WORKER_CONCURRENCY)
+    running = set()
+
+    async def run(job):
+        bot.logs.request_id.set(job.get('request_id'))
+        try:
+            if 'access_hash' in job:
+                bot.index_private_channel(int(job['channel_key'][2:]), job['access_hash'])
+            await bot.process_link_job(bot.LinkJob.from_dict(job))
+            results.send({'id': job['id'], 'shard': shard_id, 'ok': True})
+        except Exception as e:
+            logger.error("Shard worker %s failed job %s: %s", shard_id, job['id'], e)
+            results.send({'id': job['id'], 'shard': shard_id, 'ok': False, 'error': str(e)})
+        finally:
+            slots.release()
+
+    while True:
+        job = await loop.run_in_executor(None, jobs.get)
+        if job is None:
+            break
+        await slots.acquire()
+        task = asyncio.create_task(run(job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    if running:
+        await asyncio.wait(running)
+    if client_kind == 'telegram':
+        await bot.client.disconnect()
+
+class StubClient:
+    """Stands in for TelegramClient in worker processes when testing locally.
+
+    Every channel exists and every post id is a text message; forwarded and sent
+    messages are only counted.
+    """
+
+    def __init__(self):
+        self.forwarded = 0
+        self.sent = 0
+
+    async def get_entity(self, username):
+        from telethon.tl.types import Channel, ChatPhotoEmpty
+        return Channel(
+            id=_hash(username.lower()) % 10 ** 9,
+            title=username,
+            photo=ChatPhotoEmpty(),
+            date=None,
+            access_hash=_hash(username) % 10 ** 12
+        )
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        from telethon.tl.custom import Message
+        from telethon.tl.types import PeerChannel
+        return [
+            Message(id=message_id, peer_id=PeerChannel(entity.channel_id), date=None, message='stub')
+            for message_id in ids
+        ]
+
+    async def forward_messages(self, entity, messages, *args, **kwargs):
+        await asyncio.sleep(0.01)
+        self.forwarded += len(messages)
+        return messages
+
+    async def send_message(self, entity, message, *args, **kwargs):
+        self.sent += 1
+        return message
+
+async def _selftest(worker_count, job_count):
+    dispatcher = ShardDispatcher(worker_count, client_kind='stub')
+    dispatcher.start()
+    channels = [f'channel{index}' for index in range(worker_count * 4)]
+    jobs = [
+        {
+            'user_id': index,
+            'chat_id': index,
+            'channel_username': channels[index % len(channels)],
+            'channel_key': channels[index % len(channels)],
+            'message_ids': [index + 1],
+        }
+        for index in range(job_count)
+    ]
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(dispatcher.run(job) for job in jobs))
+    elapsed = time.monotonic() - started
+
+    # Every job of a channel must have been handled by the same worker
+    shards = {}
+    for job, result in zip(jobs, results):
+        shards.setdefault(job['channel_key'], set()).add(result['shard'])
+    consistent = all(len(owners) == 1 for owners in shards.values())
+
+    print(f"{job_count} jobs on {worker_count} workers in {elapsed:.2f}s")
+    print(f"Routed per worker: {dispatcher.stats()['routed']}")
+    print(f"Failed: {sum(1 for result in results if not result['ok'])}")
+    print(f"Channel routing consistent: {consistent}")
+    dispatcher.stop()
+    return consistent and all(result['ok'] for result in results)
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.WARNING
+    )
+    if '--selftest' not in sys.argv:
+        print("Usage: python sharding.py --selftest [workers] [jobs]")
+        sys.exit(2)
+
+    # The stub workers never talk to Telegram, so any credentials will do
+    os.environ.setdefault('API_ID', '1')
+    os.environ.setdefault('API_HASH', 'stub')
+    os.environ.setdefault('BOT_TOKEN', 'stub')
+
+    args = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    workers = args[0] if args else 4
+    job_count = args[1] if len(args) > 1 else 200
+    sys.exit(0 if asyncio.run(_selftest(workers, job_count)) else 1)
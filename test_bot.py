@@ -0,0 +1,782 @@
+"""Behavioral tests for the building blocks of bot.py.
+
+bot.py is loaded the way bench.py loads it, in a scratch directory with
+dummy credentials, so nothing talks to Telegram.
+
+    python -m pytest -q
+"""
+import asyncio
+import datetime
+import os
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+
+import archive
+from bench import load_bot
+import sharding
+
+bot = load_bot()
+
+
+def post(message_id):
+    return types.SimpleNamespace(id=message_id, chat=None)
+
+
+def photo_post(chat_id, message_id, file_reference=b'ref', size=100):
+    photo = bot.Photo(
+        id=message_id, access_hash=1, file_reference=file_reference, date=None,
+        sizes=[bot.PhotoSize(type='x', w=1, h=1, size=size)], dc_id=2
+    )
+    return types.SimpleNamespace(chat_id=chat_id, id=message_id, media=bot.MessageMediaPhoto(photo=photo))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_limited(self):
+        limiter = bot.RateLimiter(1, 10, 3, 100)
+        self.assertEqual([limiter.allow(1, now=0) for _ in range(4)], [True, True, True, False])
+        self.assertEqual(limiter.limited, 1)
+        # Other users have their own allowance
+        self.assertTrue(limiter.allow(2, now=0))
+
+    def test_allowance_comes_back_over_time(self):
+        limiter = bot.RateLimiter(1, 10, 1, 100)
+        self.assertTrue(limiter.allow(1, now=0))
+        self.assertFalse(limiter.allow(1, now=5))
+        self.assertTrue(limiter.allow(1, now=10))
+
+    def test_expire_frees_decayed_users(self):
+        limiter = bot.RateLimiter(1, 10, 1, 100)
+        now = time.monotonic()
+        limiter.allow(1, now=now)
+        limiter.expire(now=now + 5)
+        self.assertEqual(len(limiter), 1)
+        limiter.expire(now=now + 12)
+        self.assertEqual(len(limiter), 0)
+
+    def test_new_users_refused_when_full(self):
+        limiter = bot.RateLimiter(1, 10, 1, 2)
+        self.assertTrue(limiter.allow(1, now=0))
+        self.assertTrue(limiter.allow(2, now=0))
+        self.assertFalse(limiter.allow(3, now=0))
+
+
+class DedupWindowTest(unittest.TestCase):
+    def test_repeat_is_a_duplicate(self):
+        window = bot.DedupWindow(10, 60)
+        self.assertFalse(window.seen(1, 100))
+        self.assertTrue(window.seen(1, 100))
+        # Message ids are only unique per chat
+        self.assertFalse(window.seen(2, 100))
+        self.assertEqual(window.stats()['duplicates'], 1)
+
+    def test_ring_forgets_the_oldest(self):
+        window = bot.DedupWindow(2, 60)
+        for msg_id in (1, 2, 3):
+            window.seen(1, msg_id)
+        self.assertEqual(window.stats()['size'], 2)
+        self.assertFalse(window.seen(1, 1))
+        self.assertTrue(window.seen(1, 3))
+
+    def test_entries_expire(self):
+        window = bot.DedupWindow(10, 0)
+        window.seen(1, 100)
+        self.assertFalse(window.seen(1, 100))
+
+
+class ParseLinksTest(unittest.TestCase):
+    def test_groups_by_channel_in_order(self):
+        links = bot.parse_links(
+            'https://t.me/channel_a/5 https://t.me/channel_b/7 '
+            'https://t.me/channel_a/3 https://t.me/channel_a/5'
+        )
+        self.assertEqual(links, {'channel_a': [5, 3], 'channel_b': [7]})
+
+    def test_private_and_topic_links(self):
+        self.assertEqual(bot.parse_links('https://t.me/c/12345/67'), {'c/12345': [67]})
+        self.assertEqual(bot.parse_links('http://t.me/channel_a/10/42'), {'channel_a': [42]})
+
+    def test_invalid_usernames_are_ignored(self):
+        self.assertEqual(bot.parse_links('https://t.me/abc/1 https://t.me/1abcd/1'), {})
+        self.assertIsNone(bot.LINK_PATTERN.search('https://example.com/channel_a/1'))
+
+    def test_links_per_channel_are_capped(self):
+        text = ' '.join(f'https://t.me/channel_a/{i}' for i in range(bot.MAX_LINKS_PER_MESSAGE + 10))
+        self.assertEqual(len(bot.parse_links(text)['channel_a']), bot.MAX_LINKS_PER_MESSAGE)
+
+
+class HashRingTest(unittest.TestCase):
+    def test_same_key_same_node(self):
+        ring = sharding.HashRing(range(4))
+        self.assertEqual(ring.node_for('channel_a'), sharding.HashRing(range(4)).node_for('channel_a'))
+
+    def test_keys_spread_over_all_nodes(self):
+        ring = sharding.HashRing(range(4))
+        self.assertEqual({ring.node_for(f'channel{i}') for i in range(1000)}, {0, 1, 2, 3})
+
+    def test_adding_a_node_moves_few_keys(self):
+        keys = [f'channel{i}' for i in range(1000)]
+        before = sharding.HashRing(range(4))
+        after = sharding.HashRing(range(5))
+        moved = [key for key in keys if before.node_for(key) != after.node_for(key)]
+        # About a fifth of the keys, and only to the new node
+        self.assertLess(len(moved), 350)
+        self.assertTrue(all(after.node_for(key) == 4 for key in moved))
+
+
+class LinkSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.started = []
+        self.release = asyncio.Event()
+
+        async def handler(job):
+            self.started.append(job)
+            await self.release.wait()
+
+        self.scheduler = bot.LinkScheduler(
+            handler, worker_count=4, max_queued=10, max_per_user=2,
+            max_ranges_per_channel=1, max_ranges=1
+        )
+        self.scheduler.start()
+
+    async def asyncTearDown(self):
+        self.release.set()
+        await self.scheduler.drain(1)
+
+    async def settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_links_of_one_channel_run_side_by_side(self):
+        jobs = [bot.LinkJob(user_id, user_id, 'channel_a', [1]) for user_id in range(5)]
+        for job in jobs:
+            await self.scheduler.submit(job)
+        await self.settle()
+        # Only the workers limit them, their fetches are capped in fetch_messages
+        self.assertEqual(self.started, jobs[:4])
+
+    async def test_ranges_dont_take_link_slots(self):
+        first_range = bot.RangeJob(1, 1, 'channel_a', 1, 100)
+        second_range = bot.RangeJob(2, 2, 'channel_b', 1, 100)
+        link = bot.LinkJob(3, 3, 'channel_a', [5])
+        for job in (first_range, second_range, link):
+            await self.scheduler.submit(job)
+        await self.settle()
+        # One range runs at a time, and links of its channel still do
+        self.assertEqual(self.started, [first_range, link])
+
+    async def test_position_counts_range_waits(self):
+        self.assertEqual(await self.scheduler.submit(bot.RangeJob(1, 1, 'channel_a', 1, 100)), 0)
+        await self.settle()
+        # A free worker doesn't help a range waiting for the range cap
+        self.assertEqual(await self.scheduler.submit(bot.RangeJob(2, 2, 'channel_b', 1, 100)), 1)
+        self.assertEqual(await self.scheduler.submit(bot.LinkJob(3, 3, 'channel_a', [3])), 0)
+
+    async def test_position_follows_the_round_robin(self):
+        for user_id, channel in enumerate(('channel_a', 'channel_b', 'channel_c', 'channel_d')):
+            await self.scheduler.submit(bot.LinkJob(user_id, user_id, channel, [1]))
+        await self.settle()
+        self.assertEqual(await self.scheduler.submit(bot.LinkJob(10, 10, 'channel_e', [1])), 1)
+        self.assertEqual(await self.scheduler.submit(bot.LinkJob(11, 11, 'channel_f', [1])), 2)
+        # User 10's second job waits for a turn of both waiting users
+        self.assertEqual(await self.scheduler.submit(bot.LinkJob(10, 10, 'channel_g', [1])), 3)
+        self.assertEqual(self.scheduler.queued(10), 2)
+
+    async def test_per_user_queue_limit(self):
+        for message_id in range(3):
+            await self.scheduler.submit(bot.LinkJob(1, 1, 'channel_a', [message_id]))
+        self.assertIsNone(await self.scheduler.submit(bot.LinkJob(1, 1, 'channel_a', [9])))
+
+
+class ChannelFetchTest(unittest.IsolatedAsyncioTestCase):
+    async def test_fetches_are_capped_per_channel(self):
+        running = {'channel_a': 0, 'channel_b': 0}
+        most = dict(running)
+
+        async def fetch(channel_username, message_ids):
+            running[channel_username] += 1
+            most[channel_username] = max(most[channel_username], running[channel_username])
+            await asyncio.sleep(0.01)
+            running[channel_username] -= 1
+            return []
+
+        with mock.patch.object(bot.fetch_engine, 'fetch', fetch):
+            await asyncio.gather(*[
+                bot.fetch_messages(channel, [message_id])
+                for message_id in range(6) for channel in ('channel_a', 'channel_b')
+            ])
+        self.assertEqual(most, {'channel_a': bot.MAX_FETCHES_PER_CHANNEL, 'channel_b': bot.MAX_FETCHES_PER_CHANNEL})
+        self.assertEqual(bot.channel_fetches.stats()['keys'], 0)
+
+    async def test_popular_post_is_fetched_once_and_delivered_in_parallel(self):
+        fetches = []
+        delivering = []
+        most = [0]
+
+        async def fetch(channel_username, message_ids):
+            fetches.append(message_ids)
+            await asyncio.sleep(0.05)
+            return [post(message_id) for message_id in message_ids]
+
+        async def handler(job):
+            await cache.get(job.channel_username, job.message_ids)
+            delivering.append(job)
+            most[0] = max(most[0], len(delivering))
+            await asyncio.sleep(0.05)
+            delivering.remove(job)
+
+        cache = bot.MessageCache(fetch, 60, 100)
+        scheduler = bot.LinkScheduler(handler, worker_count=6, max_queued=100, max_per_user=2)
+        scheduler.start()
+        for user_id in range(30):
+            await scheduler.submit(bot.LinkJob(user_id, user_id, 'channel_a', [1]))
+        await asyncio.sleep(0.5)
+        await scheduler.drain(1)
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(cache.stats()['coalesced'], 5)
+        self.assertEqual(most[0], 6)
+
+
+class ResumeTest(unittest.IsolatedAsyncioTestCase):
+    async def test_resume_keeps_the_range_while_another_runs(self):
+        replies = []
+
+        async def respond(text, **kwargs):
+            replies.append(text)
+
+        event = types.SimpleNamespace(chat_id=1, respond=respond)
+        user = types.SimpleNamespace(id=1)
+        paused = bot.RangeJob(1, 1, 'channel_a', 1, 100)
+        bot.active_ranges[1] = bot.RangeJob(1, 1, 'channel_b', 1, 100)
+        bot.paused_ranges[1] = paused
+        try:
+            await bot.resume_handler(event, user)
+            self.assertIs(bot.paused_ranges.get(1), paused)
+            self.assertIn('already have a range', replies[0])
+        finally:
+            bot.active_ranges.pop(1, None)
+            bot.paused_ranges.pop(1, None)
+
+
+class DeliveryCacheTest(unittest.IsolatedAsyncioTestCase):
+    def test_hits_misses_and_eviction(self):
+        cache = bot.DeliveryCache(2)
+        self.assertFalse(cache.set(('c', 1), post(1)))  # nothing to reuse without media
+        for message_id in (1, 2, 3):
+            self.assertTrue(cache.set(('c', message_id), photo_post(7, 100 + message_id)))
+        self.assertIsNone(cache.get(('c', 1)))
+        entry = cache.get(('c', 3))
+        self.assertEqual((entry.chat_id, entry.message_id, entry.size), (7, 103, 100))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['bytes_saved'], 100)
+
+    async def test_expired_reference_is_refreshed_from_our_copy(self):
+        source = photo_post(-100, 5)
+        key = bot.delivery_key(source)
+        bot.delivery_cache.set(key, photo_post(7, 70, b'old'))
+        sent_with = []
+
+        async def send_with_media(chat_id, message, input_media):
+            sent_with.append(input_media.id.file_reference)
+            if len(sent_with) == 1:
+                raise bot.FileReferenceExpiredError(None)
+            return photo_post(chat_id, 71)
+
+        get_messages = mock.AsyncMock(return_value=photo_post(7, 70, b'new'))
+        with mock.patch.object(bot, 'send_with_media', send_with_media), \
+                mock.patch.object(bot.client, 'get_messages', get_messages):
+            await bot.resend_message(7, source)
+        self.assertEqual(sent_with, [b'old', b'new'])
+        self.assertEqual(bot.delivery_cache.peek(key).input_media.id.file_reference, b'new')
+
+    async def test_gone_copy_falls_back_to_the_original(self):
+        source = photo_post(-100, 6)
+        key = bot.delivery_key(source)
+        bot.delivery_cache.set(key, photo_post(7, 80, b'old'))
+        send_copy = mock.AsyncMock(return_value=photo_post(7, 81, b'copy'))
+        with mock.patch.object(bot, 'send_with_media', mock.AsyncMock(side_effect=bot.FileReferenceExpiredError(None))), \
+                mock.patch.object(bot.client, 'get_messages', mock.AsyncMock(return_value=None)), \
+                mock.patch.object(bot, 'send_copy', send_copy):
+            await bot.resend_message(7, source)
+        send_copy.assert_awaited_once_with(7, source)
+        self.assertEqual(bot.delivery_cache.peek(key).message_id, 81)
+
+
+    async def test_expired_album_is_refreshed_not_resent_as_is(self):
+        group = [photo_post(-100, message_id) for message_id in (7, 8)]
+        for message in group:
+            message.message = ''
+            bot.delivery_cache.set(bot.delivery_key(message), photo_post(7, 90 + message.id, b'old'))
+        sent_with = []
+
+        async def send_file(chat_id, files, **kwargs):
+            sent_with.append([media.id.file_reference for media in files])
+            if len(sent_with) == 1:
+                raise bot.FileReferenceExpiredError(None)
+            return [photo_post(chat_id, 200 + index) for index in range(len(files))]
+
+        async def get_messages(chat_id, ids):
+            return photo_post(chat_id, ids, b'new')
+
+        with mock.patch.object(bot.client, 'send_file', send_file), \
+                mock.patch.object(bot.client, 'get_messages', get_messages):
+            await bot.resend_album(7, group)
+        self.assertEqual(sent_with, [[b'old', b'old'], [b'new', b'new']])
+
+
+class FakeTransferClient:
+    """Serves file parts from bytes and collects the uploaded parts"""
+
+    def __init__(self, data, failures=0):
+        self.data = data
+        self.failures = failures  # uploads that fail before the rest succeed
+        self.uploaded = {}
+
+    async def iter_download(self, media, offset, request_size, chunk_size, limit):
+        await asyncio.sleep(0)
+        yield self.data[offset:offset + request_size]
+
+    async def __call__(self, request):
+        await asyncio.sleep(0)
+        if self.failures:
+            self.failures -= 1
+            raise OSError('connection reset')
+        self.uploaded[request.file_part] = request.bytes
+        return True
+
+    def reassembled(self):
+        return b''.join(self.uploaded[part] for part in sorted(self.uploaded))
+
+
+class TransferEngineTest(unittest.IsolatedAsyncioTestCase):
+    part = bot.TRANSFER_PART_SIZE
+
+    def document(self, size):
+        document = bot.Document(
+            id=1, access_hash=1, file_reference=b'', date=None, mime_type='video/mp4', size=size,
+            dc_id=2, attributes=[bot.DocumentAttributeFilename('clip.mp4')]
+        )
+        return bot.MessageMediaDocument(document=document)
+
+    async def transfer(self, fake, media, connections=3):
+        engine = bot.TransferEngine(connections, 2, 3)
+        with mock.patch.object(bot, 'client', fake):
+            return engine, await engine.upload_media(media)
+
+    async def test_parts_are_copied_in_order(self):
+        data = bytes(range(256)) * (self.part * 3 // 256) + b'tail'
+        fake = FakeTransferClient(data)
+        engine, media = await self.transfer(fake, self.document(len(data)))
+        self.assertEqual(fake.reassembled(), data)
+        self.assertIsInstance(media.file, bot.InputFile)
+        self.assertEqual((media.file.parts, media.file.name), (4, 'clip.mp4'))
+        self.assertEqual(media.mime_type, 'video/mp4')
+        self.assertEqual(engine.stats()['bytes'], len(data))
+
+    async def test_big_files_use_big_parts(self):
+        data = b'x' * (self.part * 2 + 1)
+        fake = FakeTransferClient(data)
+        with mock.patch.object(bot, 'TRANSFER_BIG_FILE_SIZE', self.part):
+            _, media = await self.transfer(fake, self.document(len(data)))
+        self.assertIsInstance(media.file, bot.InputFileBig)
+        self.assertEqual(fake.reassembled(), data)
+
+    async def test_failed_parts_are_retried(self):
+        data = b'y' * (self.part + 1)
+        fake = FakeTransferClient(data, failures=2)
+        await self.transfer(fake, self.document(len(data)), connections=1)
+        self.assertEqual(fake.reassembled(), data)
+
+    async def test_gives_up_after_the_retries(self):
+        data = b'z' * 10
+        fake = FakeTransferClient(data, failures=3)
+        with self.assertRaises(OSError):
+            await self.transfer(fake, self.document(len(data)))
+
+    async def test_unknown_size_is_refused(self):
+        with self.assertRaises(ValueError):
+            await self.transfer(FakeTransferClient(b''), self.document(0))
+
+
+class RunTest(unittest.TestCase):
+    def test_old_uvloop_without_run(self):
+        loops = []
+
+        async def main():
+            loops.append(type(asyncio.get_running_loop()))
+            return 'done'
+
+        class Loop(asyncio.SelectorEventLoop):
+            pass
+
+        class Policy(asyncio.DefaultEventLoopPolicy):
+            _loop_factory = Loop
+
+        old_uvloop = types.SimpleNamespace(EventLoopPolicy=Policy)
+        policy = asyncio.get_event_loop_policy()
+        try:
+            with mock.patch.dict('sys.modules', uvloop=old_uvloop), mock.patch.object(bot, 'USE_UVLOOP', True):
+                self.assertEqual(bot.run(main()), 'done')
+        finally:
+            asyncio.set_event_loop_policy(policy)
+        self.assertEqual(loops, [Loop])
+
+
+class FetchEngineTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.engine = bot.FetchEngine()
+        self.calls = []
+        self.errors = {}  # strategy name -> exception it raises
+
+        def strategy(name, **kwargs):
+            @self.engine.strategy(name, **kwargs)
+            async def run(channel_username, message_ids):
+                self.calls.append(name)
+                if name in self.errors:
+                    raise self.errors[name]
+                return [post(message_id) for message_id in message_ids]
+
+        strategy('cached')
+        strategy('fresh', fallback_for=bot.STALE_PEER_ERRORS)
+
+    async def test_fallback_never_runs_ahead(self):
+        for _ in range(bot.FETCH_MIN_SAMPLES + 5):
+            await self.engine.fetch('channel_a', [1])
+        self.assertEqual(set(self.calls), {'cached'})
+
+    async def test_fallback_runs_after_a_stale_peer(self):
+        self.errors['cached'] = bot.ChannelInvalidError(None)
+        messages = await self.engine.fetch('channel_a', [1])
+        self.assertEqual(self.calls, ['cached', 'fresh'])
+        self.assertEqual([message.id for message in messages], [1])
+
+    async def test_other_errors_dont_use_the_fallback(self):
+        self.errors['cached'] = bot.ServerError(None, 'boom')
+        with self.assertRaises(bot.ServerError):
+            await self.engine.fetch('channel_a', [1])
+        self.assertEqual(self.calls, ['cached'])
+
+    async def test_flood_wait_stops_the_fetch(self):
+        self.errors['cached'] = bot.FloodWaitError(None, capture=5)
+        with self.assertRaises(bot.FloodWaitError):
+            await self.engine.fetch('channel_a', [1])
+        self.assertEqual(self.calls, ['cached'])
+
+    async def test_new_strategies_wait_behind_working_ones(self):
+        @self.engine.strategy('other')
+        async def other(channel_username, message_ids):
+            self.calls.append('other')
+            return []
+
+        for _ in range(bot.FETCH_MIN_SAMPLES + 5):
+            await self.engine.fetch('channel_a', [1])
+        self.assertNotIn('other', self.calls)
+
+
+class MessageArchiveTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'archive.db')
+
+    def open(self, max_bytes=10 ** 9, max_age=3600):
+        store = archive.MessageArchive(self.path, max_bytes, max_age)
+        self.addCleanup(store._conn.close)
+        return store
+
+    def row(self, message_id, text='', channel_key='channel_a', channel_id=1, media_type=None,
+            protected=0, data=b'x' * 100, file_name=None):
+        return (channel_id, message_id, channel_key, 0, text, media_type, file_name, None, protected, data)
+
+    def test_get_returns_fresh_posts(self):
+        store = self.open()
+        store.put([self.row(1, data=b'one'), self.row(2, data=b'two')])
+        self.assertEqual(store.get(1, [1, 2, 3]), {1: b'one', 2: b'two'})
+        store.put([self.row(1, data=b'new')])
+        self.assertEqual(store.get(1, [1]), {1: b'new'})
+        self.assertEqual(self.open(max_age=-1).get(1, [1, 2]), {})
+
+    def test_protected_media_is_left_out(self):
+        store = self.open()
+        store.put([self.row(1, media_type='photo', protected=1), self.row(2, protected=1)])
+        self.assertEqual(list(store.get(1, [1, 2])), [2])
+
+    def test_eviction_keeps_the_size_budget(self):
+        store = self.open(max_bytes=1000)
+        for message_id in range(15):
+            store.put([self.row(message_id)])
+        self.assertLessEqual(store.bytes, 1000)
+        self.assertGreater(store.evicted, 0)
+        self.assertTrue(store.needs_compaction)
+        # The posts archived longest ago go first
+        self.assertNotIn(0, store.get(1, [0]))
+        self.assertIn(14, store.get(1, [14]))
+        # Evicted posts leave the search index too
+        self.assertEqual(store.search('hello', 10), [])
+
+    def test_compaction_keeps_posts_searchable(self):
+        store = self.open(max_bytes=1000)
+        for message_id in range(15):
+            store.put([self.row(message_id, text=f'hello number{message_id}')])
+        store.compact()
+        self.assertFalse(store.needs_compaction)
+        self.assertEqual(store.compactions, 1)
+        self.assertEqual([row[1] for row in store.search('number14', 10)], [14])
+        self.assertEqual(store.search('number0', 10), [])
+
+    def test_search_covers_public_channels_only(self):
+        store = self.open()
+        store.put([
+            self.row(1, text='quarterly report'),
+            self.row(2, text='quarterly report', channel_key='c/55', channel_id=55),
+            self.row(3, text='nothing here', file_name='report.pdf'),
+        ])
+        self.assertEqual(sorted(row[1] for row in store.search('report', 10)), [1, 3])
+        self.assertEqual(store.search('"; DROP', 10), [])
+        self.assertEqual(store.search('!!', 10), [])
+
+    def test_size_is_counted_again_on_reopen(self):
+        self.open().put([self.row(1), self.row(2)])
+        self.assertEqual(self.open().bytes, 200)
+
+
+class PendingJobsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'pending_jobs.json')
+        self.scheduler = bot.LinkScheduler(None, worker_count=1, max_queued=10, max_per_user=5)
+        for patch in (
+            mock.patch.object(bot, 'PENDING_JOBS_FILE', self.path),
+            mock.patch.object(bot, 'link_scheduler', self.scheduler),
+            mock.patch.dict(bot.active_ranges),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_jobs_survive_serialization(self):
+        link = bot.LinkJob(1, 2, 'Channel_A', [5, 6], request_id='r1')
+        restored = bot.job_from_dict(link.to_dict())
+        self.assertEqual(
+            (type(restored), restored.user_id, restored.chat_id, restored.channel_username, restored.message_ids, restored.request_id),
+            (bot.LinkJob, 1, 2, 'Channel_A', [5, 6], 'r1')
+        )
+        span = bot.RangeJob(1, 2, 'channel_a', 100, 200)
+        span.next_id = 150
+        restored = bot.job_from_dict(span.to_dict())
+        self.assertIsInstance(restored, bot.RangeJob)
+        self.assertEqual((restored.first_id, restored.next_id, restored.last_id), (100, 150, 200))
+
+    async def test_saved_jobs_are_resumed_once(self):
+        span = bot.RangeJob(3, 3, 'channel_b', 1, 50)
+        span.next_id = 20
+        bot.save_pending_jobs([bot.LinkJob(1, 1, 'channel_a', [7]), span])
+        resumed = bot.lifecycle.jobs_resumed
+        await bot.resume_pending_jobs()
+        self.assertEqual(bot.lifecycle.jobs_resumed - resumed, 2)
+        self.assertEqual((self.scheduler.queued(1), self.scheduler.queued(3)), (1, 1))
+        self.assertEqual(bot.active_ranges[3].next_id, 20)
+        self.assertFalse(os.path.exists(self.path))
+        # Nothing is resumed twice
+        await bot.resume_pending_jobs()
+        self.assertEqual(bot.lifecycle.jobs_resumed - resumed, 2)
+
+    async def test_nothing_to_save_writes_no_file(self):
+        bot.save_pending_jobs([])
+        self.assertFalse(os.path.exists(self.path))
+
+    async def test_unreadable_file_is_left_alone(self):
+        with open(self.path, 'w') as file:
+            file.write('{not json')
+        await bot.resume_pending_jobs()
+        self.assertEqual(self.scheduler.stats()['pending'], 0)
+        self.assertTrue(os.path.exists(self.path))
+
+    async def test_drain_returns_running_jobs_first(self):
+        release = asyncio.Event()
+
+        async def handler(job):
+            await release.wait()
+
+        scheduler = bot.LinkScheduler(handler, worker_count=1, max_queued=10, max_per_user=5)
+        scheduler.start()
+        running = bot.LinkJob(1, 1, 'channel_a', [1])
+        waiting = bot.LinkJob(2, 2, 'channel_a', [2])
+        await scheduler.submit(running)
+        await asyncio.sleep(0)
+        await scheduler.submit(waiting)
+        self.assertEqual(await scheduler.drain(0.01), [running, waiting])
+        self.assertEqual(scheduler.stats()['workers'], 0)
+
+
+class MessageCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fetches = []
+        self.error = None
+
+        async def fetch(channel_username, message_ids):
+            self.fetches.append(list(message_ids))
+            await asyncio.sleep(0.01)
+            if self.error is not None:
+                raise self.error
+            return [post(message_id) for message_id in message_ids if message_id != 404]
+
+        self.fetch = fetch
+
+    async def test_concurrent_requests_share_one_fetch(self):
+        cache = bot.MessageCache(self.fetch, 60, 100)
+        results = await asyncio.gather(*[cache.get('Channel_A', [1, 2]) for _ in range(10)])
+        self.assertEqual(self.fetches, [[1, 2]])
+        self.assertTrue(all([message.id for message in result] == [1, 2] for result in results))
+        self.assertEqual(cache.stats()['coalesced'], 18)
+
+    async def test_only_missing_posts_are_fetched(self):
+        cache = bot.MessageCache(self.fetch, 60, 100)
+        await cache.get('channel_a', [1])
+        messages = await cache.get('CHANNEL_A', [1, 2, 404])
+        self.assertEqual([message.id for message in messages], [1, 2])
+        self.assertEqual(self.fetches, [[1], [2, 404]])
+        # "Not found" is cached too
+        await cache.get('channel_a', [404])
+        self.assertEqual(len(self.fetches), 2)
+
+    async def test_waiting_requests_get_the_same_error(self):
+        cache = bot.MessageCache(self.fetch, 60, 100)
+        self.error = bot.ChannelPrivateError(None)
+        results = await asyncio.gather(*[cache.get('channel_a', [1]) for _ in range(3)], return_exceptions=True)
+        self.assertEqual(len(self.fetches), 1)
+        self.assertTrue(all(result is self.error for result in results))
+        # Failures aren't cached
+        self.error = None
+        self.assertEqual(len(await cache.get('channel_a', [1])), 1)
+
+    async def test_entries_expire(self):
+        cache = bot.MessageCache(self.fetch, 0, 100)
+        await cache.get('channel_a', [1])
+        await cache.get('channel_a', [1])
+        self.assertEqual(len(self.fetches), 2)
+
+
+class ApiLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_call_once_doesnt_wait_out_a_pause(self):
+        limiter = bot.ApiLimiter({}, 3, 300)
+        calls = []
+
+        async def flood():
+            calls.append(1)
+            raise bot.FloodWaitError(None, capture=30)
+
+        with self.assertRaises(bot.FloodWaitError):
+            await limiter.call_once('participant', None, flood)
+        # The pause is kept, and the next call fails without reaching Telegram
+        with self.assertRaises(bot.FloodWaitError):
+            await limiter.call_once('participant', None, flood)
+        self.assertEqual(len(calls), 1)
+
+
+class ResolveChannelTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cold_resolves_share_one_lookup(self):
+        lookups = []
+
+        async def get_entity(target):
+            lookups.append(target)
+            await asyncio.sleep(0.01)
+            return bot.Channel(id=77, title='test', photo=None, date=None, access_hash=7, username=target)
+
+        original = bot.client.get_entity
+        bot.client.get_entity = get_entity
+        try:
+            results = await asyncio.gather(*[bot.resolve_channel('Single_Flight') for _ in range(5)])
+        finally:
+            bot.client.get_entity = original
+        self.assertEqual(len(lookups), 1)
+        self.assertTrue(all(result == bot.InputPeerChannel(77, 7) for result in results))
+
+    async def test_unknown_private_channels_are_remembered(self):
+        lookups = []
+
+        async def get_entity(target):
+            lookups.append(target)
+            raise ValueError('Could not find the input entity')
+
+        calls = []
+        original_call = bot.api_limiter.call
+
+        async def call(method, peer, func, *args, **kwargs):
+            calls.append(method)
+            return await original_call(method, peer, func, *args, **kwargs)
+
+        with mock.patch.object(bot.client, 'get_entity', get_entity), \
+                mock.patch.object(bot.api_limiter, 'call', call):
+            for _ in range(3):
+                with self.assertRaises(bot.ChannelPrivateError):
+                    await bot.resolve_channel('c/424242')
+        self.assertEqual(lookups, [bot.PeerChannel(424242)])
+        # Lookups by id don't queue behind username resolves
+        self.assertEqual(calls, ['get_channel'])
+
+    async def test_private_channel_from_the_session_is_indexed(self):
+        async def get_entity(target):
+            return bot.Channel(id=target.channel_id, title='test', photo=None, date=None, access_hash=9)
+
+        with mock.patch.object(bot.client, 'get_entity', get_entity):
+            self.assertEqual(await bot.resolve_channel('c/434343'), bot.InputPeerChannel(434343, 9))
+        self.assertEqual(bot.entity_cache.get_private(434343), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class CatchUpTest(unittest.IsolatedAsyncioTestCase):
+    def message(self, message_id, sender_id, date):
+        async def get_sender():
+            return types.SimpleNamespace(id=sender_id, bot=False, first_name='test')
+
+        return types.SimpleNamespace(
+            is_private=True, text='/catchup', chat_id=sender_id, id=message_id, sender_id=sender_id,
+            date=date, get_sender=get_sender
+        )
+
+    async def test_backlog_is_capped_per_user(self):
+        handled = []
+
+        async def handler(event, user):
+            handled.append((user.id, event.id))
+
+        catch_up = bot.CatchUp(1000, 1000, 2)
+        catch_up.reset(time.time())
+        missed = datetime.datetime.fromtimestamp(catch_up.connected_at - 60, datetime.timezone.utc)
+        with mock.patch.dict(bot.commands, {'/catchup': (handler, 'default', False)}), \
+                mock.patch.object(bot, 'catch_up', catch_up):
+            for message_id in range(900001, 900005):
+                await bot.dispatch(self.message(message_id, 501, missed))
+            await bot.dispatch(self.message(900005, 502, missed))
+        self.assertEqual(handled, [(501, 900001), (501, 900002), (502, 900005)])
+        self.assertEqual(catch_up.stats()['dropped'], 2)
+
+    async def test_backlog_is_judged_by_the_server_clock(self):
+        # The local clock is an hour behind Telegram's
+        server_now = time.time() + 3600
+
+        async def call(method, peer, func, *args, **kwargs):
+            return types.SimpleNamespace(date=datetime.datetime.fromtimestamp(
+                int(server_now), datetime.timezone.utc
+            ))
+
+        with mock.patch.object(bot.api_limiter, 'call', call):
+            offset = await bot.server_clock_offset()
+        self.assertAlmostEqual(offset, 3600, delta=1.5)
+
+        catch_up = bot.CatchUp(1, 1, 1)
+        catch_up.reset(time.time() + offset)
+        live = types.SimpleNamespace(date=datetime.datetime.fromtimestamp(
+            int(server_now) + 1, datetime.timezone.utc
+        ))
+        missed = types.SimpleNamespace(date=datetime.datetime.fromtimestamp(
+            server_now - 60, datetime.timezone.utc
+        ))
+        self.assertFalse(catch_up.is_backlog(live))
+        self.assertTrue(catch_up.is_backlog(missed))